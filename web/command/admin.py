@@ -1,5 +1,6 @@
 from django.contrib import admin, messages
 from command.models import Queue, Task, TaskStatus
+from django.utils.html import format_html
 from django.utils.translation import ugettext_lazy as _
 
 def delete_model(modeladmin, request, queryset):
@@ -10,15 +11,16 @@ def delete_model(modeladmin, request, queryset):
 class TaskInline(admin.TabularInline):
     model = Task
     extra = 0
-    fields = ('id', 'line', 'depends', 'status', 'command')
-    readonly_fields = ('id', 'line', 'depends', 'status', 'command')
+    fields = ('id', 'line', 'depends', 'resource', 'status', 'command')
+    readonly_fields = ('id', 'line', 'depends', 'resource', 'status', 'command')
 
 
 class QueueAdmin(admin.ModelAdmin):
-    list_display = ['id', 'status', 'timer', 'created_at']
-    list_filter = ['status']
+    list_display = ['id', 'status', 'timer', 'node', 'created_at']
+    list_filter = ['status', 'node']
 
-    readonly_fields = ('status', 'tasks', 'started_at', 'ended_at', 'timer', 'created_at', 'updated_at')
+    readonly_fields = ('status', 'tasks', 'started_at', 'ended_at', 'timer', 'node', 'lease_expires', 'created_at',
+                       'updated_at')
     actions = [delete_model]
     inlines = [TaskInline]
 
@@ -28,19 +30,38 @@ admin.site.register(Queue, QueueAdmin)
 
 def terminate_task(modeladmin, request, queryset):
     for q in queryset.filter(status=TaskStatus.Processing.value):
-        q.set_status_terminated()
+        q.stop()
     return messages.success(request, _("Task(s) terminated."))
 
 
 class TaskAdmin(admin.ModelAdmin):
-    list_display = ['id', 'queue', 'line', 'status', 'depends', 'created_at']
-    list_filter = ['status', 'queue']
+    list_display = ['id', 'queue', 'line', 'status', 'resource', 'depends', 'percent', 'speed', 'created_at']
+    list_filter = ['status', 'resource', 'queue']
 
     readonly_fields = (
-        'name', 'depends', 'stderr', 'stdout', 'pid', 'status', 'started_at', 'ended_at', 'created_at', 'updated_at',
-        'command')
+        'name', 'depends', 'requires', 'resource', 'restart', 'restarts', 'stderr', 'stdout', 'log', 'log_content',
+        'pid', 'status',
+        'duration', 'percent', 'speed', 'teardown', 'cpu_user', 'cpu_system', 'max_rss', 'block_in', 'block_out',
+        'wall_time', 'started_at', 'ended_at', 'created_at', 'updated_at', 'command')
 
     actions = [delete_model, terminate_task]
 
+    def log_content(self, obj):
+        # Read only when task page opened, log files are not loaded for lists
+        return format_html('<pre>{}</pre>', obj.read_log())
+
+    log_content.short_description = _("Log")
+
+    def percent(self, obj):
+        return obj.percent()
+
+    percent.short_description = _("Percent")
+
+    def speed(self, obj):
+        speed = obj.speed()
+        return None if speed is None else '%.2fx' % speed
+
+    speed.short_description = _("Speed")
+
 
 admin.site.register(Task, TaskAdmin)
@@ -7,5 +7,4 @@ class TaskConfig(AppConfig):
     verbose_name = _("Command Runner")
 
     def ready(self):
-        #from command.signals import handlers
-        pass
+        import command.signals.handlers  # noqa
@@ -2,40 +2,105 @@ import os
 import signal
 import sys
 import time
+from collections import deque
+from functools import partial
 from logging import getLogger
-from threading import Thread
 
 from django.conf import settings
 from django.core.management.base import OutputWrapper
 from django.core.management.color import color_style, no_style
+from django.db import connection
+from django.db.models import Q
 from django.utils import timezone
 
 from .base.emrah import Daemon as BaseDaemon
-from .models import Queue, QueueStatus
+from .errors import CommandError, DependenceError, ProcessError
+from .metrics import COUNT_BUCKETS, DURATION_BUCKETS, MetricsServer, Registry
+from .models import Queue, QueueStatus, ResourceClass, Task, TaskStatus
+from .notify import Listener, notify
+from .pool import WorkerPool
+from .progress import without_progress
+from .scheduler import DeadlineHeap
+from .signals import queue_preparing
+from .supervisor import supervisor
+from .utils import is_command_process, pid_exists
 
 logger = getLogger('task.Daemon')
 _runfile = os.path.join(settings.BASE_DIR, '.daemon.lock')
 _pidfile = os.path.join(settings.BASE_DIR, '.daemon.pid')
 
-
-class QueueThread(Thread):
-    def __init__(self, id: int, *args, **kwargs):
-        self.id = id
-        super(QueueThread, self).__init__(daemon=True, *args, **kwargs)
-
-    def get_queue(self) -> Queue:
-        try:
-            return Queue.objects.get(id=self.id)
-        except Queue.DoesNotExist:
-            logger.exception("Queue<%d> not found." % self.id)
-            raise
-        except Exception:
-            logger.exception("Queue<%d> can not get." % self.id)
-            raise
-
-    def run(self):
-        q = self.get_queue()
-        q.start()
+registry = Registry()
+LOOP_SECONDS = registry.histogram('daemon_loop_seconds', 'Time spent in one iteration of the daemon loop.')
+LOOP_QUERIES = registry.histogram('daemon_loop_queries', 'Database queries in one iteration of the daemon loop.',
+                                  buckets=COUNT_BUCKETS)
+DISPATCH_LAG = registry.histogram('daemon_dispatch_lag_seconds', 'Delay between queue timer and queue start.')
+TASK_DURATION = registry.histogram('daemon_task_duration_seconds', 'Run time of tasks finished by the daemon.',
+                                   labels=('resource', 'status'), buckets=DURATION_BUCKETS)
+TASK_TEARDOWN = registry.histogram('daemon_task_teardown_seconds',
+                                   'Time from first termination signal to exit of terminated task processes.',
+                                   labels=('resource',))
+ACTIVE_TASKS = registry.gauge('daemon_active_tasks', 'Tasks running in the worker pools.', labels=('resource',))
+WAITING_TASKS = registry.gauge('daemon_waiting_tasks', 'Tasks waiting a free worker.', labels=('resource',))
+
+
+def run_task(id: int):
+    """Starts the task in a worker thread of the task's resource pool, returns a future done when it ends.
+
+    Worker thread is free once the process started, the task keeps its slot in the pool until the future is done.
+    """
+    try:
+        task = Task.objects.get(id=id)
+    except Task.DoesNotExist:
+        logger.exception("Task<%d> not found." % id)
+        connection.close()
+        raise
+
+    try:
+        done = task.start()
+    except (CommandError, DependenceError):
+        logger.exception("Task<%d> can not run." % id)
+        task.set_status_error()
+        return None
+    except ProcessError:
+        logger.exception("Task<%d>: Process exit with error" % id)
+        return None
+    finally:
+        connection.close()
+    done.add_done_callback(partial(observe_task, task))
+    return done
+
+
+def prepare_queue(id: int):
+    """Sends `queue_preparing` from a supervisor worker thread, so slow receivers do not delay the daemon loop."""
+    try:
+        queue = Queue.objects.all().filter(id=id, status=QueueStatus.Created.value).first()
+        if queue:
+            queue_preparing.send(sender=Queue, queue=queue)
+    except Exception:
+        logger.exception("Queue<%d> can not prepared." % id)
+    finally:
+        connection.close()
+
+
+def observe_task(task: Task, done):
+    if not done.cancelled() and done.exception() is not None:
+        logger.error("Task<%d>: Process exit with error: %s" % (task.id, done.exception()))
+    if task.started_at and task.ended_at:
+        TASK_DURATION.observe((task.ended_at - task.started_at).total_seconds(), resource=task.resource,
+                              status=task.get_status_display())
+    if task.teardown is not None:
+        TASK_TEARDOWN.observe(task.teardown, resource=task.resource)
+
+
+def watch_task(id: int):
+    """Watches process of a task started by a previous daemon, returns a future like `run_task`."""
+    try:
+        return Task.objects.get(id=id).reattach()
+    except Exception:
+        logger.exception("Task<%d> can not reattached." % id)
+        raise
+    finally:
+        connection.close()
 
 
 class DaemonError(Exception):
@@ -51,16 +116,34 @@ class DaemonNotRunning(DaemonError):
 
 
 class Daemon(BaseDaemon):
-    def __init__(self, wait=2, threshold=4, stdout=None, stderr=None, no_color=False):
+    def __init__(self, wait=30, poll=2, threshold=None, stdout=None, stderr=None, no_color=False):
         """Task Daemon: Gets task and execute them.
 
-        :arg wait : How many seconds should wait before check new records again. This should be lower than threshold
-        :arg threshold :
+        :arg wait : How many seconds should wait for a notification before check records again.
+        :arg poll : How many seconds should wait between checks when database does not support notifications.
+            This should be lower than threshold
+        :arg threshold : How many seconds a queue can start late, later ones are timed out. Defaults to
+            DAEMON_LATE_CUTOFF.
         """
         self.wait = wait
-        self.threshold = threshold
-        self.threads = []
-        self.queues = []
+        self.poll = poll
+        self.threshold = settings.DAEMON_LATE_CUTOFF if threshold is None else threshold
+        self.preroll = timezone.timedelta(seconds=settings.DAEMON_PREROLL)
+        self.prepare = timezone.timedelta(seconds=settings.DAEMON_PREPARE)
+        self.listener = Listener()
+        self.schedule = DeadlineHeap()
+        self.preparing = DeadlineHeap()  # Queues to prepare before their start time
+        self.node = settings.DAEMON_NODE
+        self.lease = settings.DAEMON_LEASE
+        self._renewed_at = 0
+        self.pools = {name: WorkerPool(name, max_workers=conf['workers'], backlog=conf['backlog'], on_done=self._done)
+                      for name, conf in settings.DAEMON_POOLS.items()}
+        self.running = {}  # Task id: Queue id
+        self.waiting = set()  # Queues with a ready task refused by a full pool
+        self.finished = deque()
+        self.metrics = None
+        ACTIVE_TASKS.function = lambda: [({'resource': n}, p.running()) for n, p in self.pools.items()]
+        WAITING_TASKS.function = lambda: [({'resource': n}, len(p) - p.running()) for n, p in self.pools.items()]
         self.stdout = OutputWrapper(stdout or sys.stdout)
         self.stderr = OutputWrapper(stderr or sys.stderr)
         if no_color:
@@ -91,6 +174,8 @@ class Daemon(BaseDaemon):
             raise DaemonNotRunning()
 
         self.stdout.write(self.style.WARNING("Trying to stop..."))
+        self.delrun()
+        notify('daemon', pid)  # Wake up daemon so it can see runfile removed
         self.__cleanstop(pid)
 
         try:
@@ -110,19 +195,75 @@ class Daemon(BaseDaemon):
         """Checks daemon is running"""
         return os.path.exists(self.runfile)
 
-    @staticmethod
-    def _is_queue_time_came(q: Queue):
-        return q.timer <= timezone.now()
+    def _start_time(self, timer):
+        """Queues are started DAEMON_PREROLL seconds before their timer, so processes are ready when it comes."""
+        return timer - self.preroll if timer else timer
+
+    def _schedule_prepare(self, id: int, timer):
+        """Queues with a timer are prepared DAEMON_PREPARE seconds before they are started, unless it is too late."""
+        prepare_time = self._start_time(timer) - self.prepare if timer and self.prepare else None
+        if prepare_time and prepare_time > timezone.now():
+            self.preparing.push(id, prepare_time)
+        else:
+            self.preparing.discard(id)
+
+    def _is_queue_time_came(self, q: Queue):
+        return q.timer is None or self._start_time(q.timer) <= timezone.now()
+
+    def _is_queue_late(self, q: Queue):
+        """Later than threshold or past its deadline, e.g. a recording whose window is already over."""
+        now = timezone.now()
+        if q.deadline is not None and q.deadline <= now:
+            return True
+        return q.timer is not None and q.timer < now - timezone.timedelta(seconds=self.threshold)
+
+    def _is_queue_active(self, id: int) -> bool:
+        return id in self.waiting or id in self.running.values()
+
+    def _done(self, id: int):
+        """Called from worker threads when a task finished."""
+        self.finished.append(id)
+        self.listener.interrupt()
+
+    def get_pool(self, task: Task) -> WorkerPool:
+        return self.pools.get(task.resource) or self.pools[ResourceClass.IO.value]
+
+    def advance(self, q: Queue):
+        """Submits every ready task of the queue to its resource pool, independent tasks run at the same time.
+
+        Queue is finished when nothing is running and nothing left to run.
+        """
+        tasks = q.ready_tasks().exclude(id__in=list(self.running))
+        running = any(queue_id == q.id for queue_id in self.running.values())
+        if not tasks and not running:
+            self.waiting.discard(q.id)
+            if q.status == QueueStatus.Created:
+                logger.warning("Daemon: Queue<%d> has no task to run." % q.id)
+            else:
+                q.finish()
+            return
+
+        self.waiting.discard(q.id)
+        for task in tasks:
+            if not self.get_pool(task).submit(task.id, run_task, task.id):
+                # Pool is full, try again when a worker finished
+                logger.debug("Daemon: Queue<%d> waiting, %s pool is full." % (q.id, task.resource))
+                self.waiting.add(q.id)
+                continue
+
+            self.running[task.id] = q.id
+            if q.status == QueueStatus.Created:
+                q.begin()
+                if q.timer:
+                    DISPATCH_LAG.observe(max((q.started_at - q.timer).total_seconds(), 0))
 
     def start_queue(self, q: Queue):
-        if not self._is_queue_time_came(q):
+        if not self._is_queue_time_came(q) or self._is_queue_active(q.id):
             return
 
         logger.debug("Daemon: Start Queue<%d>" % q.id)
         try:
-            thread = QueueThread(q.id)
-            thread.start()
-            self.threads.append(thread)
+            self.advance(q)
         except Exception:
             logger.exception("Daemon: Start Queue<%d> failed." % q.id)
             try:
@@ -130,11 +271,47 @@ class Daemon(BaseDaemon):
             except:
                 logger.exception("Daemon: Queue<%d> status can not set error." % q.id)
 
+    def recover(self):
+        """Reattaches to processes of tasks left Processing by a previous run of this node.
+
+        Tasks whose process is gone are marked Error, their queues continue with the next task.
+        """
+        mine = Q(queue__node=self.node) | Q(queue__node__isnull=True)
+        for task in Task.objects.all().filter(mine, status=TaskStatus.Processing.value, queue__isnull=False):
+            alive = task.pid and pid_exists(task.pid)
+            if alive and is_command_process(task.pid, task.get_args(), normalize=without_progress):
+                logger.info("Daemon: Task<%d> process %d is alive, reattaching." % (task.id, task.pid))
+                self.get_pool(task).submit(task.id, watch_task, task.id, force=True)
+                self.running[task.id] = task.queue_id
+            else:
+                logger.warning("Daemon: Task<%d> process %s is lost." % (task.id, task.pid))
+                task.set_status_error()
+
+        queues = self.get_queues(QueueStatus.Processing).filter(Q(node=self.node) | Q(node__isnull=True))
+        for id in queues.values_list('id', flat=True):
+            if id not in self.running.values():
+                self.waiting.add(id)
+
+    def collect(self):
+        """Advances queues of finished tasks and queues waiting for a free worker."""
+        ids = set(self.waiting)
+        while self.finished:
+            id = self.running.pop(self.finished.popleft(), None)
+            if id:
+                ids.add(id)
+
+        for q in Queue.objects.all().filter(id__in=ids):
+            try:
+                self.advance(q)
+            except Exception:
+                logger.exception("Daemon: Queue<%d> can not advanced." % q.id)
+                self.waiting.discard(q.id)
+
     def queue_timeout(self, q: Queue):
         try:
             logger.warning("Queue<%d> timeout, changing status." % q.id)
-            q.status = QueueStatus.Timeout.value
-            q.save()
+            # Only status is written, node and lease claimed for the queue are kept
+            q.transition(QueueStatus.Timeout)
         except Exception:
             logger.exception("Queue<%d> status can not changed to Timeout." % q.id)
 
@@ -142,37 +319,149 @@ class Daemon(BaseDaemon):
     def get_queues(stat: QueueStatus):
         return Queue.objects.all().filter(status=stat.value).order_by('timer')
 
-    def _add_queue_list(self, q: Queue):
-        if q.id not in self.queues:
-            logger.debug("Daemon: Queue<%d> is adding to the queues." % q.id)
-            self.queues.append(q.id)
+    def load_schedule(self):
+        """Fills deadline heap with all Created queues, only needed on start or when notifications missed."""
+        self.schedule.clear()
+        self.preparing.clear()
+        queues = self.get_queues(QueueStatus.Created).exclude(id__in=list(self.waiting) + list(self.running.values()))
+        for id, timer in queues.values_list('id', 'timer'):
+            self.schedule.push(id, self._start_time(timer))
+            self._schedule_prepare(id, timer)
+        logger.debug("Daemon: %d queue scheduled." % len(self.schedule))
+
+    def update_schedule(self, id: int):
+        """Reschedules single queue after it is created or changed."""
+        q = Queue.objects.all().filter(id=id).values_list('status', 'timer').first()
+        if q and q[0] == QueueStatus.Created.value and not self._is_queue_active(id):
+            self.schedule.push(id, self._start_time(q[1]))
+            self._schedule_prepare(id, q[1])
         else:
-            logger.debug("Daemon: Queue<%d> is already in queues." % q.id)
+            self.schedule.discard(id)
+            self.preparing.discard(id)
+
+    def _claim(self, q: Queue) -> bool:
+        if Queue.claim(q.id, self.node, self.lease):
+            return True
+
+        # Another node has it, check again when its lease expires in case that node is lost
+        logger.debug("Daemon: Queue<%d> claimed by another node." % q.id)
+        lease_expires = Queue.objects.all().filter(id=q.id).values_list('lease_expires', flat=True).first()
+        if lease_expires:
+            self.schedule.push(q.id, lease_expires)
+        return False
+
+    def renew(self):
+        """Renews leases of own queues and reclaims queues of lost nodes, runs every third of the lease."""
+        if time.monotonic() - self._renewed_at < self.lease / 3:
+            return
+        self._renewed_at = time.monotonic()
+
+        count = Queue.renew_leases(self.node, self.lease)
+        logger.debug("Daemon: %d lease renewed by %s." % (count, self.node))
+        for q in Queue.get_expired(self.node):
+            if Queue.claim(q.id, self.node, self.lease):
+                logger.warning("Daemon: Queue<%d> lease of %s expired, reclaiming." % (q.id, q.node))
+                q.requeue_interrupted_tasks()
+                # Advanced on next collect like a queue waiting for a free worker
+                self.waiting.add(q.id)
+
+    def dispatch(self):
+        """Starts queues whose timer came, late ones are started too unless they are later than threshold or past
+        their deadline. Queues about to start are prepared first.
+        """
+        for id in self.preparing.pop_due(timezone.now()):
+            supervisor.submit(prepare_queue, id)
+
+        for id in self.schedule.pop_due(timezone.now()):
+            queue = self.get_queues(QueueStatus.Created).filter(id=id).first()
+            if queue is None or not self._claim(queue):
+                continue
+            if self._is_queue_late(queue):
+                self.queue_timeout(queue)
+            else:
+                self.start_queue(queue)
+
+    def _next_wakeup(self) -> float:
+        """Seconds until next deadline in the schedule, fallback wait used if there is none."""
+        timeout = self.wait if self.listener.is_listening() else min(self.wait, self.poll)
+        for deadline in (self.schedule.next_deadline(), self.preparing.next_deadline()):
+            if deadline:
+                timeout = min(timeout, (deadline - timezone.now()).total_seconds())
+        timeout = min(timeout, self._renewed_at + self.lease / 3 - time.monotonic())
+        return max(timeout, 0)
+
+    def terminate_task(self, id: int):
+        """Terminates process of the task if it runs on this node, sends SIGTERM then SIGKILL after grace."""
+        handle = supervisor.find(Task(id=id).get_process_name())
+        if handle is None:
+            return
+        logger.info("Daemon: Terminating Task<%d>." % id)
+        handle.terminate()
+
+    def find_terminated(self):
+        """Terminates running tasks marked Terminated, for when terminate notifications can not be received."""
+        if not self.running:
+            return
+        terminated = Task.objects.all().filter(id__in=list(self.running), status=TaskStatus.Terminated.value)
+        for id in terminated.values_list('id', flat=True):
+            self.terminate_task(id)
+
+    def start_metrics(self):
+        if not settings.DAEMON_METRICS_PORT:
+            return
+        try:
+            self.metrics = MetricsServer(registry, settings.DAEMON_METRICS_PORT, settings.DAEMON_METRICS_HOST)
+            self.metrics.start()
+        except OSError:
+            logger.exception("Daemon: Metrics can not served on %s:%d." % (settings.DAEMON_METRICS_HOST,
+                                                                          settings.DAEMON_METRICS_PORT))
 
     def run(self):
         start_time = timezone.now()
+        self.start_metrics()
+        connection.force_debug_cursor = True  # Count queries per loop
+        self.listener.connect()
+        supervisor.start()
+        self.recover()
+        self.load_schedule()
         try:
             while self.is_running():
-                for queue in self.get_queues(QueueStatus.Processing):
-                    queue.calculate_queue_status()
-
-                for queue in self.get_queues(QueueStatus.Created):
-                    if queue.timer:
-                        # Check is timeout
-                        if queue.timer < timezone.now() - timezone.timedelta(seconds=self.threshold):
-                            self.queue_timeout(queue)
-                        else:
-                            self.start_queue(queue)
-                    else:
-                        self.start_queue(queue)
+                loop_start = time.monotonic()
+                connection.queries_log.clear()
+
+                self.renew()
+                self.collect()
+                self.dispatch()
 
                 # Log every 10 seconds
                 passed = (timezone.now() - start_time).total_seconds()
                 if int(passed) % 10 == 0:
                     logger.debug("Daemon: Running %d seconds." % passed)
-                time.sleep(self.wait)
+
+                LOOP_SECONDS.observe(time.monotonic() - loop_start)
+                LOOP_QUERIES.observe(len(connection.queries_log))
+                listening = self.listener.is_listening()
+                events = self.listener.wait(self._next_wakeup())
+                if not self.listener.is_listening() or not listening:
+                    # Without notifications changes can only be found by reloading
+                    self.load_schedule()
+                    self.find_terminated()
+
+                for kind, id in events:
+                    logger.debug("Daemon: Woke up by %s<%s>." % (kind, id))
+                    if kind == 'queue' and id is not None:
+                        self.update_schedule(id)
+                    elif kind == 'terminate' and id is not None:
+                        self.terminate_task(id)
         except Exception:
             logger.exception("Daemon: Failed.")
             self.delrun()
             raise DaemonError()
+        finally:
+            self.listener.close()
+            for pool in self.pools.values():
+                pool.shutdown(wait=False)
+            supervisor.stop()
+            if self.metrics:
+                self.metrics.stop()
         logger.warning("Daemon: Exiting.")
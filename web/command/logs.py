@@ -0,0 +1,106 @@
+import gzip
+import os
+import shutil
+from logging import getLogger
+
+logger = getLogger('task.logs')
+
+
+def log_files(path: str) -> list:
+    """Existing files of the log, current one first then rotated ones from newest to oldest."""
+    files = []
+    for name in [path] + ['%s.%d' % (path, i) for i in range(1, 100)]:
+        if os.path.exists(name):
+            files.append(name)
+        elif os.path.exists(name + '.gz'):
+            files.append(name + '.gz')
+        elif name != path:
+            break
+    return files
+
+
+def _open(path: str):
+    return gzip.open(path, 'rb') if path.endswith('.gz') else open(path, 'rb')
+
+
+def read_tail(path: str, size: int) -> str:
+    """Last `size` bytes of the log, read from rotated files too if current one is shorter."""
+    data = b''
+    for name in log_files(path):
+        with _open(name) as f:
+            if name.endswith('.gz'):
+                content = f.read()[-size:]
+            else:
+                f.seek(max(os.path.getsize(name) - size, 0))
+                content = f.read()
+        data = content + data
+        if len(data) >= size:
+            break
+    return data[-size:].decode('utf-8', 'replace')
+
+
+def delete_log(path: str):
+    for name in log_files(path):
+        try:
+            os.remove(name)
+        except OSError:
+            logger.exception("Log file can not deleted: %s" % name)
+
+
+class RotatingLog:
+    def __init__(self, path: str, max_bytes: int, backup_count: int = 0, compress: bool = False):
+        """Append only log file, rotated when it exceeds `max_bytes`, oldest rotation is dropped after
+        `backup_count` files. Files are gzipped when closed if `compress` is set.
+        """
+        self.path = path
+        self.max_bytes = max_bytes
+        self.backup_count = backup_count
+        self.compress = compress
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        self.file = open(path, 'ab')
+        self.size = self.file.tell()
+
+    def write(self, data: bytes):
+        if not data:
+            return
+        if self.max_bytes and self.size + len(data) > self.max_bytes and self.size > 0:
+            self.rotate()
+        self.file.write(data)
+        self.size += len(data)
+
+    def rotate(self):
+        self.file.close()
+        for i in range(self.backup_count - 1, 0, -1):
+            for ext in ('', '.gz'):
+                src = '%s.%d%s' % (self.path, i, ext)
+                if os.path.exists(src):
+                    for old in ('%s.%d' % (self.path, i + 1), '%s.%d.gz' % (self.path, i + 1)):
+                        if os.path.exists(old):
+                            os.remove(old)
+                    os.replace(src, '%s.%d%s' % (self.path, i + 1, ext))
+        if self.backup_count > 0:
+            os.replace(self.path, self.path + '.1')
+        else:
+            os.remove(self.path)
+        self.file = open(self.path, 'wb')
+        self.size = 0
+
+    def close(self):
+        self.file.close()
+        if not self.compress:
+            return
+        for name in log_files(self.path):
+            if name.endswith('.gz'):
+                continue
+            try:
+                with open(name, 'rb') as src, gzip.open(name + '.gz', 'wb') as dst:
+                    shutil.copyfileobj(src, dst)
+                os.remove(name)
+            except OSError:
+                logger.exception("Log file can not compressed: %s" % name)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
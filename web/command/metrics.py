@@ -0,0 +1,175 @@
+from http.server import BaseHTTPRequestHandler, HTTPServer
+from logging import getLogger
+from threading import Lock, Thread
+
+logger = getLogger('task.metrics')
+
+CONTENT_TYPE = 'text/plain; version=0.0.4; charset=utf-8'
+
+SECONDS_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2, 4, 8, 15, 30, 60)
+DURATION_BUCKETS = (1, 10, 60, 300, 900, 1800, 3600, 7200, 14400)
+BYTES_BUCKETS = tuple(2 ** i * 1024 * 1024 for i in range(0, 16, 2))  # 1 MiB to 16 GiB
+COUNT_BUCKETS = (0, 1, 2, 5, 10, 20, 50, 100)
+
+
+def _escape(value) -> str:
+    return str(value).replace('\\', '\\\\').replace('"', '\\"').replace('\n', '\\n')
+
+
+def _format_labels(labels: dict) -> str:
+    if not labels:
+        return ''
+    return '{%s}' % ','.join('%s="%s"' % (k, _escape(v)) for k, v in labels.items())
+
+
+def _format_value(value) -> str:
+    if value == float('inf'):
+        return '+Inf'
+    return repr(float(value))
+
+
+class Metric:
+    type = None
+
+    def __init__(self, name: str, help: str, labels: tuple = ()):
+        self.name = name
+        self.help = help
+        self.labels = tuple(labels)
+        self._values = {}
+        self._lock = Lock()
+
+    def _key(self, labels: dict) -> tuple:
+        return tuple(str(labels.get(l, '')) for l in self.labels)
+
+    def samples(self):
+        """Yields (name, labels, value) of each sample."""
+        with self._lock:
+            values = list(self._values.items())
+        for key, value in values:
+            yield self.name, dict(zip(self.labels, key)), value
+
+    def render(self) -> str:
+        lines = ['# HELP %s %s' % (self.name, self.help), '# TYPE %s %s' % (self.name, self.type)]
+        lines += ['%s%s %s' % (name, _format_labels(labels), _format_value(value))
+                  for name, labels, value in self.samples()]
+        return '\n'.join(lines)
+
+
+class Counter(Metric):
+    type = 'counter'
+
+    def inc(self, amount: float = 1, **labels):
+        key = self._key(labels)
+        with self._lock:
+            self._values[key] = self._values.get(key, 0) + amount
+
+
+class Gauge(Metric):
+    type = 'gauge'
+
+    def __init__(self, name: str, help: str, labels: tuple = (), function=None):
+        """:arg function : Called on render instead of stored values, returns (labels, value) pairs."""
+        super(Gauge, self).__init__(name, help, labels)
+        self.function = function
+
+    def set(self, value: float, **labels):
+        with self._lock:
+            self._values[self._key(labels)] = value
+
+    def samples(self):
+        if self.function is None:
+            yield from super(Gauge, self).samples()
+            return
+        try:
+            for labels, value in self.function():
+                yield self.name, labels, value
+        except Exception:
+            logger.exception("Metric<%s>: Value can not collected." % self.name)
+
+
+class Histogram(Metric):
+    type = 'histogram'
+
+    def __init__(self, name: str, help: str, labels: tuple = (), buckets: tuple = SECONDS_BUCKETS):
+        super(Histogram, self).__init__(name, help, labels)
+        self.buckets = tuple(sorted(buckets)) + (float('inf'),)
+
+    def observe(self, value: float, **labels):
+        key = self._key(labels)
+        with self._lock:
+            counts, total = self._values.get(key, ([0] * len(self.buckets), 0))
+            for i, bound in enumerate(self.buckets):
+                if value <= bound:
+                    counts[i] += 1
+            self._values[key] = (counts, total + value)
+
+    def samples(self):
+        with self._lock:
+            values = [(key, (list(counts), total)) for key, (counts, total) in self._values.items()]
+        for key, (counts, total) in values:
+            labels = dict(zip(self.labels, key))
+            for bound, count in zip(self.buckets, counts):
+                yield self.name + '_bucket', dict(labels, le=_format_value(bound)), count
+            yield self.name + '_sum', labels, total
+            yield self.name + '_count', labels, counts[-1]
+
+
+class Registry:
+    def __init__(self):
+        self.metrics = {}
+
+    def _add(self, metric: Metric) -> Metric:
+        if metric.name in self.metrics:
+            raise ValueError("Metric %s already registered." % metric.name)
+        self.metrics[metric.name] = metric
+        return metric
+
+    def counter(self, name: str, help: str, labels: tuple = ()) -> Counter:
+        return self._add(Counter(name, help, labels))
+
+    def gauge(self, name: str, help: str, labels: tuple = (), function=None) -> Gauge:
+        return self._add(Gauge(name, help, labels, function=function))
+
+    def histogram(self, name: str, help: str, labels: tuple = (), buckets: tuple = SECONDS_BUCKETS) -> Histogram:
+        return self._add(Histogram(name, help, labels, buckets=buckets))
+
+    def render(self) -> str:
+        return '\n'.join(m.render() for m in self.metrics.values()) + '\n'
+
+
+# Functions adding database derived metrics to a registry, rendered by the /metrics view.
+collectors = []
+
+
+def register_collector(fn):
+    collectors.append(fn)
+    return fn
+
+
+class MetricsServer(Thread):
+    def __init__(self, registry: Registry, port: int, address: str = '127.0.0.1'):
+        """Serves registry in Prometheus text format for scraping the daemon, on loopback unless `address` is set."""
+        super(MetricsServer, self).__init__(name='MetricsServer', daemon=True)
+        self.registry = registry
+
+        class Handler(BaseHTTPRequestHandler):
+            def do_GET(handler):
+                body = self.registry.render().encode('utf-8')
+                handler.send_response(200)
+                handler.send_header('Content-Type', CONTENT_TYPE)
+                handler.send_header('Content-Length', str(len(body)))
+                handler.end_headers()
+                handler.wfile.write(body)
+
+            def log_message(handler, format, *args):
+                pass
+
+        self.server = HTTPServer((address, port), Handler)
+
+    def run(self):
+        logger.debug("MetricsServer: Listening %s:%d." % self.server.server_address[:2])
+        self.server.serve_forever()
+
+    def stop(self):
+        self.server.shutdown()
+        self.server.server_close()
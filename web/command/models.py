@@ -1,17 +1,25 @@
 import os
-import signal
-import subprocess
-import time
-from datetime import datetime
+import shlex
+from concurrent.futures import Future
 from logging import getLogger
+from queue import Queue as CallQueue
 
+from django.conf import settings
 from django.contrib.contenttypes.models import ContentType
-from django.db import models
+from django.contrib.postgres.fields import JSONField
+from django.db import connection, models, transaction
+from django.db.models import Case, Count, Q, Sum, When
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
 from command.errors import CommandError, DependenceError, ProcessError, StatusError, TaskError
-from command.utils import pid_exists
+from command.logs import RotatingLog, read_tail
+from command.notify import notify
+from command.policy import Policy, get_policy
+from command.progress import ProgressSeries, is_ffmpeg, with_progress
+from command.signals import task_restarting, task_running, task_starting
+from command.supervisor import supervisor
+from command.utils import merge_usage
 
 from ffmpeg.utils import ChoiceEnum
 
@@ -36,16 +44,53 @@ class QueueStatus(ChoiceEnum):
     Completed = 2
 
 
+class ResourceClass(ChoiceEnum):
+    IO = 'io'  # Stream copy, bound by network and disk
+    CPU = 'cpu'  # Transcoding, bound by cores
+
+
+# Statuses a task can not leave without being run again
+ENDED_STATUSES = (TaskStatus.Completed.value, TaskStatus.Error.value, TaskStatus.Terminated.value)
+
+
 class Task(models.Model):
     queue = models.ForeignKey('Queue', null=True, blank=True, on_delete=models.CASCADE)
     line = models.PositiveSmallIntegerField(default=0)
     name = models.CharField(max_length=15, null=True, blank=True)
     depends = models.ForeignKey('Task', null=True, blank=True)
+    # Other tasks which should be completed before, with depends they make a dependency graph
+    requires = models.ManyToManyField('Task', blank=True, symmetrical=False, related_name='required_by',
+                                      verbose_name=_('Requires'))
+    # Runs once dependencies ended whatever their status, e.g. to save what a failed task produced
+    always_run = models.BooleanField(default=False, verbose_name=_('Run After Failure'))
     timeout = models.TimeField(null=True, blank=True)
-
+    # Process exited with error is started again before the deadline, waiting TASK_RESTART_BACKOFF seconds doubled on
+    # every restart as long as total wait is in TASK_RESTART_BUDGET
+    restart = models.BooleanField(default=False, verbose_name=_('Restart on Error'))
+    restarts = models.PositiveSmallIntegerField(default=0, verbose_name=_('Restarts'))
+    resource = models.CharField(max_length=5, choices=ResourceClass.choices(), default=ResourceClass.IO.value,
+                                verbose_name=_('Resource Class'))
+
+    # Output is written to log file, fields keep only last TASK_LOG_TAIL bytes
     stderr = models.TextField(verbose_name=_('StdErr'), null=True, blank=True)
     stdout = models.TextField(verbose_name=_('StdOut'), null=True, blank=True)
-    pid = models.PositiveSmallIntegerField(null=True, blank=True)
+    log = models.CharField(max_length=255, null=True, blank=True, verbose_name=_('Log File'))
+    # Pids go up to pid_max, 4194304 on 64 bit systems
+    pid = models.PositiveIntegerField(null=True, blank=True)
+    # Seconds from first termination signal to process exit, set if process is terminated
+    teardown = models.FloatField(null=True, blank=True, verbose_name=_('Teardown Seconds'))
+
+    # Resource usage of the process and its children from wait4, set when process exits
+    cpu_user = models.FloatField(null=True, blank=True, verbose_name=_('User CPU Seconds'))
+    cpu_system = models.FloatField(null=True, blank=True, verbose_name=_('System CPU Seconds'))
+    max_rss = models.PositiveIntegerField(null=True, blank=True, verbose_name=_('Max RSS (KiB)'))
+    block_in = models.PositiveIntegerField(null=True, blank=True, verbose_name=_('Blocks Read'))
+    block_out = models.PositiveIntegerField(null=True, blank=True, verbose_name=_('Blocks Written'))
+    wall_time = models.FloatField(null=True, blank=True, verbose_name=_('Wall Seconds'))
+
+    # ffmpeg -progress reports as time series, duration is expected output length in seconds for percent
+    progress = JSONField(null=True, blank=True, verbose_name=_('Progress'))
+    duration = models.FloatField(null=True, blank=True, verbose_name=_('Duration'))
 
     status = models.SmallIntegerField(verbose_name=_('Status'), choices=TaskStatus.choices(),
                                       default=int(TaskStatus.Created))
@@ -57,6 +102,8 @@ class Task(models.Model):
     updated_at = models.DateTimeField(auto_now=True, verbose_name=_('Last Update Time'))
 
     command = models.TextField()
+    # Run by /bin/sh, otherwise command is split to argv and executed directly
+    shell = models.BooleanField(default=True, verbose_name=_('Run in Shell'))
 
     class Meta:
         verbose_name = _("Task")
@@ -84,35 +131,31 @@ class Task(models.Model):
             logger.exception("Task<%d>: Error while get self." % self.id)
             raise
 
-    def _add_stderr(self):
-        err: bytes = self.ps.stderr.readline()
-        if err:
-            self.stderr = self.stderr + err.decode('utf-8') if self.stderr else err.decode('utf-8')
-            self.save(update_fields=['stderr'])
-
-    def _add_stdout(self):
-        try:
-            if self.ps.stdout.readable():
-                out: bytes = self.ps.stdout.readline()
-                if out:
-                    self.stdout = self.stdout + out.decode('utf-8') if self.stdout else out.decode('utf-8')
-                    self.save(update_fields=['stdout'])
-        except Exception:
-            logger.exception("Stdout can not saved.")
+    def transition(self, stat: TaskStatus = None, **fields):
+        """Writes a lifecycle step, status and other fields together, in a single UPDATE.
 
-    def _set_status(self, stat: TaskStatus):
-        if self.status == stat:
-            logger.warning("Task<%d>: Status already %s can not change." % (self.id, stat.name))
+        post_save is sent once for the step, so queue status is calculated once instead of for every field.
+        """
+        if stat is not None:
+            if self.status == stat:
+                logger.warning("Task<%d>: Status already %s can not change." % (self.id, stat.name))
+            else:
+                logger.debug("Task<%d>: Status changing %s to %s." % (self.id, self.get_status_display(), stat.name))
+                fields['status'] = int(stat)
+        if not fields:
             return
 
         try:
-            logger.debug("Task<%d>: Status changing %s to %s." % (self.id, self.get_status_display(), stat.name))
-            self.status = int(stat)
-            self.save(update_fields=['status'])
+            for name, value in fields.items():
+                setattr(self, name, value)
+            self.save(update_fields=list(fields) + ['updated_at'])
         except Exception:
-            logger.exception("Status can not changed.")
+            logger.exception("Task<%d>: Transition can not saved." % self.id)
             raise
 
+    def _set_status(self, stat: TaskStatus):
+        self.transition(stat)
+
     def set_status_terminated(self):
         self._set_status(TaskStatus.Terminated)
 
@@ -126,66 +169,127 @@ class Task(models.Model):
         self._set_status(TaskStatus.Completed)
 
     def _is_process_allive(self):
-        return (self.ps.poll() is None) if self.ps else False
+        return self.ps.is_alive() if self.ps else False
 
-    def _is_task_terminated(self):
-        return self._get_self().status == TaskStatus.Terminated
+    def get_timeout_seconds(self) -> float or None:
+        """Timeout is stored as a duration in a time field."""
+        if self.timeout is None:
+            return None
+        return float(self.timeout.hour * 3600 + self.timeout.minute * 60 + self.timeout.second)
 
     def is_timeout(self):
-        return datetime.combine(self.started_at, self.timeout) > timezone.now()
+        return self.started_at + timezone.timedelta(seconds=self.get_timeout_seconds()) < timezone.now()
 
-    def _save_process_stderr(self):
-        """Read process stderr output and saves it to the model logs."""
-        try:
-            logger.debug("Task<%d>: Saving process stderr." % self.id)
-            # Save Console Output
-            self.stderr = "".join([l.decode('utf-8') for l in self.ps.stderr.readlines()])
-            self.save(update_fields=['stderr'])
-        except Exception:
-            logger.exception("Task<%d>: Saving stderr failed." % self.id)
+    def get_remaining_seconds(self) -> float or None:
+        """Seconds left to the deadline, None if task has no timeout."""
+        if self.timeout is None or not self.started_at:
+            return None
+        passed = (timezone.now() - self.started_at).total_seconds()
+        return max(self.get_timeout_seconds() - passed, 0)
 
-    def _save_process_stdout(self):
-        try:
-            out = "".join([l.decode('utf-8') for l in self.ps.stdout.readlines()])
-            if out:
-                self.stdout = self.stdout + out if self.stdout else out
-                self.save(update_fields=['stdout'])
-        except Exception:
-            logger.exception("Stdout can not saved.")
+    def get_log_path(self) -> str:
+        return os.path.join(settings.TASK_LOG_DIR, 'task-%d.log' % self.id)
+
+    def _open_log(self):
+        self.log = self.get_log_path()
+        self._log = RotatingLog(self.log, settings.TASK_LOG_MAX_BYTES, settings.TASK_LOG_BACKUP_COUNT,
+                                settings.TASK_LOG_COMPRESS)
+
+    def _process_output(self) -> dict:
+        """Closes the log file output written to, returns output fields to save with the last transition.
 
-    def _set_start_time(self):
+        Only a short tail of output kept on the model.
+        """
+        fields = {}
         try:
-            self.started_at = timezone.now()
-            self.save(update_fields=['started_at'])
+            self._log.close()
+            fields['stdout'] = self.ps.stdout.decode('utf-8', 'replace')
+            fields['stderr'] = self.ps.stderr.decode('utf-8', 'replace')
+            if getattr(self, '_progress', None) is not None:
+                fields['progress'] = self._progress.to_json()
         except Exception:
-            logger.exception("Start time can not saved.")
-            raise
+            logger.exception("Task<%d>: Process output can not read." % self.id)
+        return fields
+
+    def read_log(self, size: int = None) -> str:
+        """Tail of the task log file."""
+        if not self.log:
+            return ''
+        return read_tail(self.log, size or settings.TASK_LOG_TAIL)
 
-    def _set_end_time(self):
+    def _save_progress(self):
+        if getattr(self, '_progress', None) is None:
+            return
         try:
-            self.ended_at = timezone.now()
-            self.save(update_fields=['ended_at'])
+            self.transition(progress=self._progress.to_json())
         except Exception:
-            logger.exception("End time can not saved.")
-            raise
-
-    def _start_process(self):
+            logger.exception("Task<%d>: Progress can not saved." % self.id)
+
+    def percent(self) -> float or None:
+        """Percent of expected duration processed, None if duration or progress unknown."""
+        if not self.duration or not self.progress:
+            return None
+        out_time = self.progress.get('last', {}).get('out_time')
+        if out_time is None:
+            return None
+        return min(round(out_time * 100 / self.duration, 1), 100.0)
+
+    def speed(self) -> float or None:
+        """Last reported speed relative to real time, below 1 means process is falling behind the stream."""
+        if not self.progress:
+            return None
+        return self.progress.get('last', {}).get('speed')
+
+    def _start_process(self, restart: bool = False):
+        """Starts the process, on restart it only gets the time left to deadline and writes to the same log."""
         logger.debug("Running Command: %s" % self.command)
-        try:
-            self.ps = subprocess.Popen(self.command, shell=True, stdout=subprocess.PIPE, stderr=subprocess.PIPE)
-            self.set_status_processing()
-        except subprocess.SubprocessError:
+        command, pipes = self.command, None
+        if is_ffmpeg(self.command):
+            # Progress reports are written to an extra pipe, stdout and stderr are left as they are
+            read_fd, write_fd = os.pipe()
+            self._progress = ProgressSeries(settings.TASK_PROGRESS_POINTS)
+            command = with_progress(self.command, write_fd)
+            pipes = [(read_fd, write_fd, self._progress.feed)]
+
+        # Policy of the resource class, e.g. so transcodes can not starve recordings of CPU and disk
+        args = self.get_policy().prefix() + self.get_args(command)
+        if restart:
+            self._usage = merge_usage(getattr(self, '_usage', None), self.ps.usage)
+        else:
+            self._open_log()
+        timeout = self.get_remaining_seconds() if restart else self.get_timeout_seconds()
+        self.ps = supervisor.spawn(args, timeout=timeout,
+                                   sink=self._log.write, tail=settings.TASK_LOG_TAIL, pipes=pipes,
+                                   name=self.get_process_name(), interrupt=settings.TASK_INTERRUPT_GRACE,
+                                   grace=settings.TASK_KILL_GRACE)
+        self.ps.wait_started()
+        if self.ps.error:
+            self._log.close()
             self.set_status_error()
-            logger.exception("Task<%d>: Process could not started" % self.id)
-            raise
+            logger.error("Task<%d>: Process could not started" % self.id)
+            raise ProcessError(self.ps.error)
 
-        try:
-            # Save Pid
-            self.pid = self.ps.pid
-            self.save(update_fields=['pid'])
-        except Exception:
-            logger.exception("Task<%d>: Pid can not saved" % self.id)
-            raise
+        if restart:
+            self.transition(pid=self.ps.pid)
+            return
+        # Log can be read while process is running
+        self.transition(TaskStatus.Processing, pid=self.ps.pid, log=self.log, started_at=timezone.now())
+
+    def get_policy(self) -> Policy:
+        return get_policy(settings.TASK_POLICIES, self.resource)
+
+    def get_args(self, command: str = None) -> list:
+        """Argv the process of the task runs once prefix tools of its policy exec it, so also its command line.
+
+        :arg command : Command to run instead of task's own, e.g. with options added when started.
+        """
+        command = command or self.command
+        args = ['/bin/sh', '-c', command] if self.shell else shlex.split(command)
+        return self.get_policy().adjust(args, ffmpeg=is_ffmpeg(command) and not self.shell)
+
+    def get_process_name(self) -> str:
+        """Name of the task's process in supervisor."""
+        return repr(self)
 
     def _terminate_process(self):
         if not self.ps:
@@ -198,51 +302,132 @@ class Task(models.Model):
         except Exception:
             logger.exception("Task<%d>: Process can not terminated." % self.id)
 
-    def _loop(self):
+    def _watch(self):
+        """Saves progress every 10 seconds and ends the task when process exits, without a thread waiting it.
 
+        Steps run from `_submit` as they may block on database, timeout is enforced by supervisor.
+        """
         if not self.ps:
-            logger.error("Task<%d>: Loop method called but process not found." % self.id)
+            logger.error("Task<%d>: Watch method called but process not found." % self.id)
             raise ValueError("Process not found")
 
-        start_time = timezone.now()
-        error = False
-        while self._is_process_allive():
-            passed = (timezone.now() - start_time).total_seconds()
-            if self.timeout and self.is_timeout():
-                error = True
-                logger.error("Task<%d>: Process react Timeout." % self.id)
-                self._terminate_process()
-                self.terminate()
-                self.set_status_terminated()
-                break
+        self.ps.every(10, lambda: self._call(self._tick))
+        self.ps.add_done_callback(lambda: self._call(self._exited))
 
-            # Do Every 10 seconds
-            if int(passed) % 10 == 0:
-                if self._is_task_terminated():  # Check Task is terminated
-                    error = True
-                    logger.warning("Task<%d>: Terminated by user." % self.id)
-                    self._terminate_process()
-                    self.terminate()
-                    break
-                logger.debug("Task<{id}>: Working for {seconds} seconds".format(id=self.id, seconds=int(passed)))
-            time.sleep(1)  # Wait
-
-        if not error:
-            self.set_status_completed()
+    def _call(self, fn, *args):
+        """Submits a step of the task, task ends with the error if the step fails."""
+        def call():
+            if self._done.done():
+                return
+            try:
+                fn(*args)
+            except Exception as err:
+                logger.exception("Task<%d>: %s failed." % (self.id, fn.__name__))
+                self._done.set_exception(err)
 
-    def _run(self):
-        """!IMPORTANT: This method should not call directly, call 'run' method instead"""
-        self._start_process()
-        self._set_start_time()
-        self._loop()
-        self._set_end_time()
+        self._submit(call)
+
+    def _tick(self):
+        if not self.ps.is_alive():
+            return
+        passed = (timezone.now() - self.started_at).total_seconds() if self.started_at else 0
+        logger.debug("Task<{id}>: Working for {seconds} seconds".format(id=self.id, seconds=int(passed)))
+        self._save_progress()
+        try:
+            task_running.send(sender=Task, task=self)
+        except Exception:
+            logger.exception("Task<%d>: Running signal failed." % self.id)
+
+    def _exit_status(self) -> TaskStatus or None:
+        """Status task ended with, None if status is already set."""
+        if self.ps.timed_out:
+            logger.error("Task<%d>: Process react Timeout, stopped in %s seconds." % (self.id, self.ps.teardown))
+            return TaskStatus.Terminated
+        if self.ps.terminated:
+            # Stopped by daemon on request, status is already Terminated
+            logger.warning("Task<%d>: Terminated by user, stopped in %s seconds." % (self.id, self.ps.teardown))
+            return None
+        return TaskStatus.Completed if self.ps.returncode in (0, None) else TaskStatus.Error
+
+    def _exited(self):
+        stat = self._exit_status()
+        delay = self._restart_delay() if stat == TaskStatus.Error else None
+        if delay is None:
+            self._finish(stat)
+            return
+        logger.warning("Task<%d>: Process exit with %s, restarting in %s seconds." % (
+            self.id, self.ps.returncode, delay))
+        # Supervisor waits the delay, no thread sleeps for it
+        supervisor.call_later(delay, self._call, self._restart, timezone.now())
+
+    def _restart_delay(self) -> float or None:
+        """Seconds to wait before starting failed process again, None if it should not be restarted."""
+        if not self.restart:
+            return None
+        delay = settings.TASK_RESTART_BACKOFF * 2 ** self.restarts
+        # Waited for earlier restarts, backoff is doubled every time
+        waited = settings.TASK_RESTART_BACKOFF * (2 ** self.restarts - 1)
+        if waited + delay > settings.TASK_RESTART_BUDGET:
+            return None
+        remaining = self.get_remaining_seconds()
+        if remaining is not None and remaining <= delay:
+            return None
+        return delay
+
+    def _restart(self, exited_at):
+        """Starts failed process again, the task ends as after the first run."""
+        if self._get_self().status != TaskStatus.Processing:
+            logger.warning("Task<%d>: Stopped while waiting to restart." % self.id)
+            self._finish(None)
+            return
 
-        if self.ps.returncode == 0:
-            self._save_process_stdout()
+        self.transition(restarts=self.restarts + 1)
+        try:
+            task_restarting.send(sender=Task, task=self, exited_at=exited_at)
+        except Exception:
+            logger.exception("Task<%d>: Restarting signal failed, process not restarted." % self.id)
+            self._finish(TaskStatus.Error)
+            return
+        self._start_process(restart=True)
+        self._watch()
+
+    def _finish(self, stat: TaskStatus or None):
+        if self.ps.args is None:
+            # Adopted process, its output and usage are not known
+            self.transition(stat, ended_at=timezone.now(), teardown=self.ps.teardown)
         else:
-            self.set_status_error()
-            self._save_process_stderr()
-        return self
+            usage = merge_usage(getattr(self, '_usage', None), self.ps.usage)
+            self.transition(stat, ended_at=timezone.now(), teardown=self.ps.teardown, **self._process_output(),
+                            **(usage or {}))
+        self._done.set_result(self)
+
+    def _start(self, submit=None) -> Future:
+        """!IMPORTANT: This method should not call directly, call 'start' or 'run' method instead"""
+        self._submit = submit or supervisor.submit
+        self._done = Future()
+        try:
+            task_starting.send(sender=Task, task=self)
+        except Exception:
+            logger.exception("Task<%d>: Starting signal failed." % self.id)
+        self._start_process()
+        self._watch()
+        return self._done
+
+    def reattach(self, submit=None) -> Future:
+        """Watches process of a task left Processing by a previous daemon, future is done when it exits.
+
+        Exit code of the process can not be known, task is completed unless it is terminated or timed out.
+        """
+        if self.status != TaskStatus.Processing:
+            raise StatusError("Task<%d>: Can not reattach, task is not processing." % self.id)
+
+        logger.info("Task<%d>: Reattaching to process %d." % (self.id, self.pid))
+        self._submit = submit or supervisor.submit
+        self._done = Future()
+        self.ps = supervisor.adopt(self.pid, timeout=self.get_remaining_seconds(), name=self.get_process_name(),
+                                   interrupt=settings.TASK_INTERRUPT_GRACE, grace=settings.TASK_KILL_GRACE)
+        self._watch()
+        return self._done
 
     def _can_run(self):
         if self.status == TaskStatus.Completed:
@@ -253,37 +438,63 @@ class Task(models.Model):
         elif self.status == TaskStatus.Processing:
             raise StatusError("Task<%d>: Can not run already started call `terminate` method for cancel." % self.id)
 
-    def run(self, check=False):
-        if self.depends and self.depends.status != TaskStatus.Completed:
-            raise DependenceError("Task dependence on Task<%d> and task not completed." % self.depends.id)
+    def get_dependencies(self) -> list:
+        """Tasks which should be completed before this one, `depends` and `requires` together."""
+        tasks = list(self.requires.all()) if self.pk else []
+        if self.depends and self.depends not in tasks:
+            tasks.insert(0, self.depends)
+        return tasks
+
+    def _check_runnable(self):
+        allowed = ENDED_STATUSES if self.always_run else (TaskStatus.Completed.value,)
+        for dependence in self.get_dependencies():
+            if dependence.status not in allowed:
+                raise DependenceError("Task dependence on Task<%d> and task not completed." % dependence.id)
 
         if (self.command is None) or (self.command == ""):
             raise CommandError("Task<%d>: Command is not set." % self.id)
 
         self._can_run()
 
+    def start(self, submit=None) -> Future:
+        """Starts the task and returns at once, future is done with the task when it ends.
+
+        Later steps, saving progress, restarting and ending the task, are run by `submit`, supervisor's workers by
+        default.
+        """
+        self._check_runnable()
+        return self._start(submit)
+
+    def run(self, check=False):
+        """Runs the task until it ends, later steps are run in the calling thread."""
+        self._check_runnable()
+
+        calls = CallQueue()
         try:
-            self._run()
+            done = self._start(calls.put)
+            while not done.done():
+                calls.get()()
+            done.result()
             if check and (self.status == TaskStatus.Error or self.status == TaskStatus.Terminated):
                 raise ProcessError("Process exit with error.")
         except Exception as err:
             raise ProcessError(err)
 
     def terminate(self):
-        """Terminate the process if allive"""
-        if pid_exists(self.pid):
-            try:
-                while True:
-                    os.kill(self.pid, signal.SIGTERM)
-                    time.sleep(0.1)
-            except OSError as err:
-                err = str(err)
-
-                if err.find('No such process') > 0:
-                    logger.debug("Task<%d>: Terminated, pid %d." % (self.id, self.pid))
-                    self.set_status_terminated()
-                else:
-                    logger.exception("Task<%d> can not terminated." % self.id)
+        """Terminates the process if allive, SIGINT first so output is finalized then SIGTERM and SIGKILL.
+
+        Process run by another instance is terminated by its daemon.
+        """
+        if getattr(self, 'ps', None) is None:
+            self.stop()
+            return
+        self.set_status_terminated()
+        self._terminate_process()
+
+    def stop(self):
+        """Marks the task Terminated and notifies daemons, the one running it terminates the process."""
+        self.set_status_terminated()
+        notify('terminate', self.id)
 
     def print(self):
         for k, v in self.__dict__.items():
@@ -297,6 +508,13 @@ class Queue(models.Model):
     ended_at = models.DateTimeField(null=True, blank=True, verbose_name=_('Task Ended'))
 
     timer = models.DateTimeField(null=True, blank=True)
+    # Queue found after its deadline is timed out instead of started, e.g. when window of a recording is over
+    deadline = models.DateTimeField(null=True, blank=True, verbose_name=_('Deadline'))
+
+    # Daemon node which claimed the queue, claim is valid until lease expires
+    node = models.CharField(max_length=100, null=True, blank=True, verbose_name=_('Node'))
+    lease_expires = models.DateTimeField(null=True, blank=True, verbose_name=_('Lease Expires'))
+
     created_at = models.DateTimeField(auto_now_add=True, verbose_name=_('Created Time'))
     updated_at = models.DateTimeField(auto_now=True, verbose_name=_('Last Update Time'))
 
@@ -310,45 +528,111 @@ class Queue(models.Model):
     def __str__(self):
         return str(self.id)
 
+    @staticmethod
+    def claim(id: int, node: str, lease: int) -> bool:
+        """Takes the queue for the node for `lease` seconds.
+
+        Returns False if another node holds a valid lease or is claiming it at the same time.
+        """
+        now = timezone.now()
+        skip_locked = connection.features.has_select_for_update_skip_locked
+        with transaction.atomic():
+            claimable = Queue.objects.select_for_update(skip_locked=skip_locked).filter(
+                Q(node__isnull=True) | Q(node=node) | Q(lease_expires__lt=now), id=id)
+            if not claimable.exists():
+                return False
+            Queue.objects.filter(id=id).update(node=node, lease_expires=now + timezone.timedelta(seconds=lease))
+        return True
+
+    @staticmethod
+    def renew_leases(node: str, lease: int) -> int:
+        """Extends leases of the node's unfinished queues, returns how many renewed."""
+        return Queue.objects.filter(
+            node=node, status__in=[QueueStatus.Created.value, QueueStatus.Processing.value]
+        ).update(lease_expires=timezone.now() + timezone.timedelta(seconds=lease))
+
+    @staticmethod
+    def get_expired(node: str):
+        """Processing queues of other nodes which stopped renewing their lease."""
+        return Queue.objects.all().filter(status=QueueStatus.Processing.value,
+                                          lease_expires__lt=timezone.now()).exclude(node=node)
+
+    def requeue_interrupted_tasks(self):
+        """Puts tasks left Processing by a lost node back to Created, so the node taking the queue over runs them.
+
+        They start over with a new deadline, e.g. a late recording is shortened to its window when it starts.
+        """
+        for task in self.tasks().filter(status=TaskStatus.Processing.value):
+            logger.warning("Queue<%d>: Task<%d> interrupted, queued again." % (self.id, task.id))
+            task.transition(TaskStatus.Created, pid=None, started_at=None, ended_at=None)
+
+    def count_tasks(self) -> dict:
+        """Counts all, Error, Terminated, Completed and Processing tasks of the queue in one query."""
+        def count(stat: TaskStatus):
+            return Sum(Case(When(status=stat.value, then=1), default=0, output_field=models.IntegerField()))
+
+        counts = self.tasks().aggregate(total=Count('id'), error=count(TaskStatus.Error),
+                                        terminated=count(TaskStatus.Terminated),
+                                        completed=count(TaskStatus.Completed),
+                                        processing=count(TaskStatus.Processing))
+        # Sum is None when queue has no task
+        return {key: value or 0 for key, value in counts.items()}
+
     def calculate_queue_status(self):
-        if self.tasks().filter(status=TaskStatus.Error.value).exists():
-            self.set_status_error()
-        elif self.tasks().filter(status=TaskStatus.Completed.value).count() == self.tasks().count():
+        counts = self.count_tasks()
+        if counts['error'] or counts['terminated']:
+            # Tasks not depending on failed ones still run, e.g. a parallel branch waiting for a free worker, and
+            # `always_run` ones run after failure. Queue ends once they did, tasks depending on failed ones never run.
+            if counts['processing'] or self.ready_tasks().exists():
+                self.set_status_processing()
+            elif counts['error']:
+                self.set_status_error()
+            else:
+                self.set_status_stopped()
+        elif counts['completed'] == counts['total']:
             self.set_status_completed()
-        elif self.tasks().filter(status=TaskStatus.Processing.value).exists():
+        elif counts['processing']:
             self.set_status_processing()
 
     def tasks(self):
         """Returns tasks"""
         return Task.objects.all().filter(queue=self)
 
-    def _set_start_time(self):
-        try:
-            self.started_at = timezone.now()
-            self.save(update_fields=['started_at'])
-        except Exception:
-            logger.exception("Queue<%d>: Start time can not saved." % self.id)
-            raise
+    def ready_tasks(self):
+        """Created tasks whose dependencies all completed, or all ended for `always_run` ones, in line order.
+
+        They can run at the same time.
+        """
+        not_completed = Task.objects.all().exclude(status=TaskStatus.Completed.value)
+        not_ended = Task.objects.all().exclude(status__in=ENDED_STATUSES)
+        completed = ((Q(depends__isnull=True) | Q(depends__status=TaskStatus.Completed.value)) &
+                     ~Q(requires__in=not_completed))
+        ended = (Q(depends__isnull=True) | Q(depends__status__in=ENDED_STATUSES)) & ~Q(requires__in=not_ended)
+        return self.tasks().filter(Q(always_run=False) & completed | Q(always_run=True) & ended,
+                                   status=TaskStatus.Created.value)
+
+    def next_task(self) -> Task or None:
+        """First ready task in line order, None if nothing left to run."""
+        return self.ready_tasks().first()
+
+    def transition(self, stat: QueueStatus = None, **fields):
+        """Writes status and other fields of a lifecycle step in a single UPDATE, see `Task.transition`."""
+        if stat is not None and self.status != stat:
+            logger.debug("Queue<%d>: Status changing %s to %s." % (self.id, self.get_status_display(), stat.name))
+            fields['status'] = int(stat)
+        if not fields:
+            return
 
-    def _set_end_time(self):
         try:
-            self.ended_at = timezone.now()
-            self.save(update_fields=['ended_at'])
+            for name, value in fields.items():
+                setattr(self, name, value)
+            self.save(update_fields=list(fields) + ['updated_at'])
         except Exception:
-            logger.exception("Queue<%d>: End time can not saved." % self.id)
+            logger.exception("Queue<%d>: Transition can not saved." % self.id)
             raise
 
     def _set_status(self, stat: QueueStatus):
-        if self.status == stat:
-            return
-
-        try:
-            logger.debug("Queue<%d>: Status changing %s to %s." % (self.id, self.get_status_display(), stat.name))
-            self.status = int(stat)
-            self.save(update_fields=['status'])
-        except Exception:
-            logger.exception("Status can not changed.")
-            raise
+        self.transition(stat)
 
     def set_status_stopped(self):
         self._set_status(QueueStatus.Stopped)
@@ -373,18 +657,17 @@ class Queue(models.Model):
             raise
 
     def _loop(self):
-        for task in self.tasks():
+        """Runs ready tasks one by one in topological order, tasks depending on a failed one never run.
+
+        Daemon runs ready tasks of a queue at the same time instead.
+        """
+        tried = set()
+        while True:
+            task = self.ready_tasks().exclude(id__in=tried).first()
+            if task is None:
+                break
+            tried.add(task.id)
             try:
-                if task.status != TaskStatus.Created:
-                    logger.warning(
-                        "Queue<%d>: Passing, Task<%d> status %s." % (self.id, task.id, task.get_status_display()))
-                    continue
-
-                if task.depends and task.depends.status != TaskStatus.Completed:
-                    logger.warning(
-                        "Queue<%d>: Task<%d> dependence Task<%d> not completed." % (self.id, task.id, task.depends.id))
-                    continue
-
                 try:
                     logger.info("Queue<%d>: Starting Task<%d>." % (self.id, task.id))
                     task.run()
@@ -406,17 +689,22 @@ class Queue(models.Model):
             logger.warning("Queue<%d>: There is no task to run." % self.id)
             return
 
-        logger.debug("Queue<%d>: Starting..." % self.id)
-        self.set_status_processing()
-        self._set_start_time()
+        self.begin()
         self._loop()
-        self._set_end_time()
+        self.finish()
+
+    def begin(self):
+        logger.debug("Queue<%d>: Starting..." % self.id)
+        self.transition(QueueStatus.Processing, started_at=timezone.now())
+
+    def finish(self):
+        self.transition(ended_at=timezone.now())
         logger.debug("Queue<%d>: End." % self.id)
 
     def stop(self):
         for task in self.tasks().filter(status=TaskStatus.Processing):
             try:
-                task.set_status_terminated()
+                task.stop()
             except Exception:
                 logger.exception("Task could not stopped: %s" % task.id)
         self.set_status_stopped()
@@ -429,8 +717,8 @@ class Queue(models.Model):
             if self.status != QueueStatus.Created:
                 raise StatusError("Queue<%d>: Status not valid to add Task<%d>." % (self.id, task.id))
 
-            if task.depends:
-                self.add(Task.objects.get(id=task.depends.id))
+            for dependence in task.get_dependencies():
+                self.add(Task.objects.get(id=dependence.id))
 
             if self.tasks().filter(id=task.id).exists():
                 logger.warning("Queue<%d>: Task<%d> already in queue." % (self.id, task.id))
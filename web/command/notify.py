@@ -0,0 +1,105 @@
+import os
+import select
+from logging import getLogger
+
+from django.db import connection, transaction
+
+logger = getLogger('task.notify')
+
+CHANNEL = 'command_daemon'
+
+
+def is_supported() -> bool:
+    """LISTEN/NOTIFY only exists on PostgreSQL, other backends falls back to polling."""
+    return connection.vendor == 'postgresql'
+
+
+def notify(kind: str, id: int):
+    """Wakes up listening daemons after current transaction committed. Payload is 'kind:id'."""
+    if not is_supported():
+        return
+
+    payload = "%s:%d" % (kind, id)
+
+    def send():
+        try:
+            with connection.cursor() as cursor:
+                cursor.execute("SELECT pg_notify(%s, %s)", [CHANNEL, payload])
+        except Exception:
+            logger.exception("Notify: %s can not send." % payload)
+
+    transaction.on_commit(send)
+
+
+def parse_payload(payload: str) -> (str, int):
+    kind, _, id = payload.partition(':')
+    try:
+        return kind, int(id)
+    except ValueError:
+        return kind, None
+
+
+class Listener:
+    def __init__(self, channel: str = CHANNEL):
+        """Blocks until a notification arrives on the channel, `interrupt` wakes it up from other threads."""
+        self.channel = channel
+        self.conn = None
+        self._rpipe, self._wpipe = os.pipe()
+
+    def is_listening(self) -> bool:
+        return self.conn is not None
+
+    def connect(self):
+        if not is_supported():
+            logger.warning("Listener: Database does not support notifications, polling will be used.")
+            return
+
+        try:
+            # Dedicated connection, so ORM queries of the daemon never consume notifications.
+            self.conn = connection.get_new_connection(connection.get_connection_params())
+            self.conn.autocommit = True
+            with self.conn.cursor() as cursor:
+                cursor.execute('LISTEN "%s"' % self.channel)
+            logger.debug("Listener: Listening '%s'." % self.channel)
+        except Exception:
+            logger.exception("Listener: Can not listen '%s'." % self.channel)
+            self.close()
+
+    def close(self):
+        if self.conn is not None:
+            try:
+                self.conn.close()
+            except Exception:
+                logger.exception("Listener: Connection can not closed.")
+        self.conn = None
+
+    def interrupt(self):
+        os.write(self._wpipe, b'\0')
+
+    def wait(self, timeout: float) -> list:
+        """Waits `timeout` seconds at most, returns received (kind, id) tuples."""
+        if self.conn is None and is_supported():
+            self.connect()
+
+        fds = [self._rpipe]
+        if self.conn is not None:
+            fds.append(self.conn)
+
+        try:
+            readable, _, _ = select.select(fds, [], [], max(timeout, 0))
+        except InterruptedError:
+            return []
+
+        if self._rpipe in readable:
+            os.read(self._rpipe, 1024)
+
+        events = []
+        if self.conn is not None and self.conn in readable:
+            try:
+                self.conn.poll()
+                while self.conn.notifies:
+                    events.append(parse_payload(self.conn.notifies.pop(0).payload))
+            except Exception:
+                logger.exception("Listener: Connection lost, reconnecting.")
+                self.close()
+        return events
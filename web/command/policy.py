@@ -0,0 +1,77 @@
+import shutil
+from logging import getLogger
+
+logger = getLogger('task.policy')
+
+# ffmpeg options without a value, every other option is followed by its value
+FFMPEG_FLAGS = frozenset(['-y', '-n', '-nostdin', '-stdin', '-hide_banner', '-stats', '-nostats', '-re', '-shortest',
+                          '-an', '-vn', '-sn', '-dn', '-copyts', '-start_at_zero', '-xerror', '-benchmark',
+                          '-ignore_unknown', '-report', '-accurate_seek', '-noaccurate_seek', '-dump', '-hex'])
+
+
+def output_indexes(args: list) -> list:
+    """Indexes of output files in an ffmpeg argv, arguments which are neither an option nor a value of one."""
+    indexes, i = [], 1
+    while i < len(args):
+        if args[i].startswith('-') and args[i] != '-':
+            i += 1 if args[i] in FFMPEG_FLAGS else 2
+        else:
+            indexes.append(i)
+            i += 1
+    return indexes
+
+
+def _which(tool: str) -> str or None:
+    path = shutil.which(tool)
+    if path is None:
+        logger.warning("Policy: %s not found, it is not applied." % tool)
+    return path
+
+
+class Policy:
+    def __init__(self, cpus: str = None, nice: int = 0, ionice: str = None, threads: int = 0):
+        """Execution policy of a resource class, applied by prefixing argv with taskset, nice and ionice.
+
+        Prefix tools exec the command, so pid and command line of the process stay the command's own.
+
+        :arg cpus : CPUs the process can run on in taskset list format, e.g. '0-3,6'.
+        :arg nice : Niceness added to the process.
+        :arg ionice : IO scheduling class and level as 'class[:level]', e.g. 'idle' or 'best-effort:7'.
+        :arg threads : Thread count passed to ffmpeg, 0 leaves it to ffmpeg.
+        """
+        self.cpus = cpus or None
+        self.nice = nice or 0
+        self.ionice = ionice or None
+        self.threads = threads or 0
+
+    def __repr__(self):
+        return "<Policy: cpus=%s nice=%s ionice=%s threads=%s>" % (self.cpus, self.nice, self.ionice, self.threads)
+
+    def prefix(self) -> list:
+        args = []
+        if self.cpus and _which('taskset'):
+            args += ['taskset', '-c', self.cpus]
+        if self.nice and _which('nice'):
+            args += ['nice', '-n', str(self.nice)]
+        if self.ionice and _which('ionice'):
+            cls, _, level = self.ionice.partition(':')
+            args += ['ionice', '-c', cls] + (['-n', level] if level else [])
+        return args
+
+    def adjust(self, args: list, ffmpeg: bool = False) -> list:
+        """Argv of the command itself under the policy, what the process runs once prefix tools exec it."""
+        if ffmpeg and self.threads:
+            # Encoder option, it applies to the next output only so it is given before each of them
+            args = list(args)
+            for index in reversed(output_indexes(args)):
+                args[index:index] = ['-threads', str(self.threads)]
+        return args
+
+    def apply(self, args: list, ffmpeg: bool = False) -> list:
+        """Returns argv run under the policy, `ffmpeg` should be set if args are an ffmpeg command."""
+        return self.prefix() + self.adjust(args, ffmpeg=ffmpeg)
+
+
+def get_policy(policies: dict, resource: str) -> Policy:
+    """Policy of the resource class from a `TASK_POLICIES` like dict, empty policy if class has none."""
+    return Policy(**policies.get(resource, {}))
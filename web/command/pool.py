@@ -0,0 +1,115 @@
+from collections import deque
+from concurrent.futures import CancelledError, Future, ThreadPoolExecutor
+from functools import partial
+from logging import getLogger
+from threading import Lock
+
+logger = getLogger('task.pool')
+
+
+class WorkerPool:
+    def __init__(self, name: str, max_workers: int, backlog: int = 0, on_done=None):
+        """Runs at most `max_workers` jobs at the same time.
+
+        A job returning a future keeps its slot until that future is done but frees its thread, e.g. a task waiting
+        its process.
+
+        :arg backlog : How many jobs can wait for a free worker, submit is refused when backlog is full.
+        :arg on_done : Called with job id from worker thread when a job finished.
+        """
+        self.name = name
+        self.max_workers = max_workers
+        self.capacity = max_workers + backlog
+        self.on_done = on_done
+        self.jobs = {}
+        self._waiting = deque()
+        self._active = 0
+        self._lock = Lock()
+        self._executor = ThreadPoolExecutor(max_workers=max_workers)
+
+    def __contains__(self, id):
+        return id in self.jobs
+
+    def __len__(self):
+        return len(self.jobs)
+
+    def free(self) -> int:
+        """How many jobs can be submitted right now."""
+        return max(self.capacity - len(self.jobs), 0)
+
+    def is_full(self) -> bool:
+        return self.free() == 0
+
+    def running(self) -> int:
+        return sum(1 for f in list(self.jobs.values()) if f.running())
+
+    def submit(self, id: int, fn, *args, force: bool = False) -> bool:
+        """Queues the job, returns False if pool is full so caller can retry later.
+
+        :arg force : Accept even if backlog is full, for jobs which can not be delayed.
+        """
+        with self._lock:
+            if id in self.jobs:
+                logger.debug("Pool<%s>: Job<%d> already submitted." % (self.name, id))
+                return True
+            if len(self.jobs) >= self.capacity and not force:
+                logger.debug("Pool<%s>: Full, Job<%d> refused." % (self.name, id))
+                return False
+            future = Future()
+            self.jobs[id] = future
+            self._waiting.append((future, fn, args))
+        future.add_done_callback(partial(self._done, id))
+        self._dispatch()
+        return True
+
+    def _dispatch(self):
+        with self._lock:
+            while self._waiting and self._active < self.max_workers:
+                self._active += 1
+                self._executor.submit(self._run, *self._waiting.popleft())
+
+    def _run(self, future: Future, fn, args):
+        if not future.set_running_or_notify_cancel():
+            self._release()
+            return
+        try:
+            result = fn(*args)
+        except Exception as err:
+            future.set_exception(err)
+            return
+        if isinstance(result, Future):
+            result.add_done_callback(partial(self._chain, future))
+        else:
+            future.set_result(result)
+
+    @staticmethod
+    def _chain(future: Future, result: Future):
+        if result.cancelled():
+            future.set_exception(CancelledError())
+        elif result.exception() is not None:
+            future.set_exception(result.exception())
+        else:
+            future.set_result(result.result())
+
+    def _release(self):
+        with self._lock:
+            self._active -= 1
+        self._dispatch()
+
+    def _done(self, id, future):
+        with self._lock:
+            self.jobs.pop(id, None)
+        if not future.cancelled():
+            self._release()
+
+        if not future.cancelled() and future.exception():
+            logger.error("Pool<%s>: Job<%d> failed: %s" % (self.name, id, future.exception()))
+
+        if self.on_done:
+            try:
+                self.on_done(id)
+            except Exception:
+                logger.exception("Pool<%s>: Job<%d> done callback failed." % (self.name, id))
+
+    def shutdown(self, wait=True):
+        self._executor.shutdown(wait=wait)
@@ -0,0 +1,104 @@
+import math
+import os
+import re
+import shlex
+import time
+from array import array
+
+# Keys of ffmpeg -progress output kept in the series
+FIELDS = ('frame', 'fps', 'bitrate', 'total_size', 'out_time', 'speed', 'drop_frames')
+
+
+def is_ffmpeg(command: str) -> bool:
+    try:
+        args = shlex.split(command)
+    except ValueError:
+        return False
+    return bool(args) and os.path.basename(args[0]) == 'ffmpeg'
+
+
+def with_progress(command: str, fd: int) -> str:
+    """Adds `-progress pipe:fd` to an ffmpeg command, it is a global option so placed right after executable."""
+    executable, _, rest = command.strip().partition(' ')
+    return "%s -progress pipe:%d %s" % (executable, fd, rest)
+
+
+def without_progress(command: str) -> str:
+    """Reverse of `with_progress`, so a running command can be compared with the task's command.
+
+    It is removed wherever it is, e.g. after options a policy added.
+    """
+    return re.sub(r' -progress pipe:\d+(?= |$)', '', command.strip(), count=1)
+
+
+def _parse_value(key: str, value: str) -> float:
+    value = value.strip()
+    if key == 'bitrate':
+        value = value.replace('kbits/s', '')
+    elif key == 'speed':
+        value = value.rstrip('x')
+    try:
+        return float(value)
+    except ValueError:
+        return float('nan')
+
+
+class ProgressSeries:
+    def __init__(self, max_points: int = 720):
+        """Time series of ffmpeg progress reports kept in arrays.
+
+        When `max_points` reached every second point is dropped and only half of the reports are recorded from then
+        on, so a series covers whole run of the process with bounded memory.
+        """
+        self.max_points = max_points
+        self.started = time.monotonic()
+        self.time = array('d')
+        self.values = {key: array('d') for key in FIELDS}
+        self.last = {}
+        self.ended = False
+        self._stride = 1
+        self._count = 0
+        self._buffer = b''
+        self._current = {}
+
+    def feed(self, data: bytes):
+        """Parses `key=value` lines, each report ends with a `progress` line."""
+        self._buffer += data
+        *lines, self._buffer = self._buffer.split(b'\n')
+        for line in lines:
+            key, _, value = line.decode('utf-8', 'replace').partition('=')
+            key = key.strip()
+            if key == 'progress':
+                self._add(self._current)
+                self.ended = value.strip() == 'end'
+                self._current = {}
+            elif key in ('out_time_us', 'out_time_ms'):
+                # Both are microseconds
+                self._current['out_time'] = _parse_value(key, value) / 1000000
+            elif key in FIELDS and key != 'out_time':
+                self._current[key] = _parse_value(key, value)
+
+    def _add(self, report: dict):
+        self.last = report
+        self._count += 1
+        if (self._count - 1) % self._stride:
+            return
+
+        if len(self.time) >= self.max_points:
+            self.time = self.time[::2]
+            self.values = {key: values[::2] for key, values in self.values.items()}
+            self._stride *= 2
+
+        self.time.append(round(time.monotonic() - self.started, 3))
+        for key in FIELDS:
+            self.values[key].append(report.get(key, float('nan')))
+
+    def to_json(self) -> dict:
+        def clean(value):
+            return None if math.isnan(value) else value
+
+        data = {key: [clean(v) for v in values] for key, values in self.values.items()}
+        data['time'] = list(self.time)
+        data['last'] = {key: clean(value) for key, value in self.last.items()}
+        data['ended'] = self.ended
+        return data
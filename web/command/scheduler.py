@@ -0,0 +1,50 @@
+import heapq
+from datetime import datetime
+
+
+class DeadlineHeap:
+    def __init__(self):
+        """Min-heap of queue ids ordered by timer.
+
+        Updated entries are not removed from the heap, they are skipped when popped if timer does not match anymore.
+        """
+        self._heap = []
+        self._timers = {}
+
+    def __len__(self):
+        return len(self._timers)
+
+    def __contains__(self, id):
+        return id in self._timers
+
+    def clear(self):
+        self._heap = []
+        self._timers = {}
+
+    def push(self, id: int, timer: datetime = None):
+        """Adds or reschedules the queue, queues without timer are due immediately."""
+        timer = timer or datetime.min
+        if self._timers.get(id) == timer:
+            return
+        self._timers[id] = timer
+        heapq.heappush(self._heap, (timer, id))
+
+    def discard(self, id: int):
+        self._timers.pop(id, None)
+
+    def _drop_stale(self):
+        while self._heap and self._timers.get(self._heap[0][1]) != self._heap[0][0]:
+            heapq.heappop(self._heap)
+
+    def next_deadline(self) -> datetime or None:
+        self._drop_stale()
+        return self._heap[0][0] if self._heap else None
+
+    def pop_due(self, now: datetime, limit: int = None) -> list:
+        """Removes and returns ids whose timer is reached, earliest first."""
+        due = []
+        while self.next_deadline() is not None and self._heap[0][0] <= now and (limit is None or len(due) < limit):
+            timer, id = heapq.heappop(self._heap)
+            del self._timers[id]
+            due.append(id)
+        return due
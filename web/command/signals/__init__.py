@@ -0,0 +1,12 @@
+from django.dispatch import Signal
+
+# Sent before process of a task is started, receivers can prepare inputs of its command.
+task_starting = Signal(providing_args=['task'])
+# Sent from a worker thread of the daemon DAEMON_PREPARE seconds before a queue with a timer is started, receivers can
+# warm up inputs of its tasks, e.g. resolve streams, so starting them does not wait on the network.
+queue_preparing = Signal(providing_args=['queue'])
+# Sent from the thread running a task every time it wakes up while the process is running, about every 10 seconds.
+task_running = Signal(providing_args=['task'])
+# Sent before a failed process of a restartable task is started again, receivers can change `task.command`, e.g. to
+# record only rest of a stream. `exited_at` is when the failed process exited.
+task_restarting = Signal(providing_args=['task', 'exited_at'])
@@ -1,17 +1,43 @@
-from ..models import Task
+from ..logs import delete_log
+from ..models import Queue, Task
+from ..notify import notify
 from django.dispatch import receiver
-from django.db.models.signals import post_save
+from django.db.models.signals import post_delete, post_save
 
 from logging import getLogger
 
 logger = getLogger('task.signals.handlers')
 
 
+def _is_changed(update_fields, *fields) -> bool:
+    return update_fields is None or any(f in update_fields for f in fields)
+
+
 @receiver(post_save, sender=Task)
-def on_task_status_change(task: Task, created, **kwargs):
-    if not created and task.queue:
+def on_task_status_change(instance: Task, created, update_fields=None, **kwargs):
+    # Output and progress saves do not change queue status
+    if not created and instance.queue_id and _is_changed(update_fields, 'status'):
         try:
-            logger.debug("Task<%d>: Chec")
-            task.queue.calculate_queue_status()
+            logger.debug("Task<%d>: Checking Queue<%d> status." % (instance.id, instance.queue_id))
+            instance.queue.calculate_queue_status()
         except Exception:
-            logger.exception("Task<%d>: Queue<%d> status can not calculated." % (task.id, task.queue.id))
+            logger.exception("Task<%d>: Queue<%d> status can not calculated." % (instance.id, instance.queue_id))
+
+
+@receiver(post_save, sender=Task)
+def notify_task_change(instance: Task, created, update_fields=None, **kwargs):
+    if instance.queue_id and _is_changed(update_fields, 'status'):
+        notify('task', instance.id)
+
+
+@receiver(post_save, sender=Queue)
+def notify_queue_change(instance: Queue, created, update_fields=None, **kwargs):
+    if created or _is_changed(update_fields, 'status', 'timer'):
+        notify('queue', instance.id)
+
+
+@receiver(post_delete, sender=Task)
+def delete_task_log(instance: Task, **kwargs):
+    # Sent for queryset and cascade deletes too, which do not call Task.delete
+    if instance.log:
+        delete_log(instance.log)
@@ -0,0 +1,361 @@
+import asyncio
+import os
+import signal
+import subprocess
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from logging import getLogger
+
+from .utils import RingBuffer, pid_exists
+
+CHUNK_SIZE = 64 * 1024
+# Seconds between exit checks of a process when pidfd is not supported
+REAP_INTERVAL = 0.1
+
+logger = getLogger('task.supervisor')
+
+
+class ProcessHandle:
+    def __init__(self, args: list, timeout: float = None, sink=None, tail: int = 4096, pipes: list = None,
+                 name: str = None, interrupt: float = None, grace: float = None):
+        """Process started by the supervisor, methods are safe to call from any thread.
+
+        :arg timeout : Seconds process can run, measured by loop's monotonic clock, then it is terminated.
+        :arg name : Key to find the handle from supervisor, e.g. to terminate it from another thread.
+        :arg interrupt : Termination starts with SIGINT if set, e.g. so ffmpeg finalizes its output, SIGTERM is sent
+            after this many seconds.
+        :arg grace : Seconds to wait after SIGTERM before process group is killed, never killed if None.
+        :arg sink : Called with every chunk of output from supervisor thread, e.g. to write a log file.
+        :arg tail : How many bytes of stdout and stderr kept in memory.
+        :arg pipes : Extra pipes as (read fd, write fd, sink) created by caller, write end is passed to the process
+            and read end is drained to the sink like output. Supervisor closes both ends.
+        """
+        self.args = args
+        self.timeout = timeout
+        self.sink = sink
+        self.pipes = pipes or []
+        self.name = name
+        self.interrupt = interrupt
+        self.grace = grace
+        self._stdout = RingBuffer(tail)
+        self._stderr = RingBuffer(tail)
+        self.pid = None
+        self.returncode = None
+        self.error = None
+        self.timed_out = False
+        self.terminated = False
+        self.teardown = None  # Seconds from first signal to exit
+        self.usage = None  # Resource usage of the process and its children, set when it exits
+        self._terminating_at = None
+        self.process = None
+        self.loop = None
+        self._started = threading.Event()
+        self._exited = threading.Event()
+        self._callbacks = []
+        self._lock = threading.Lock()
+
+    def __repr__(self):
+        return "<ProcessHandle: %s>" % self.pid
+
+    @property
+    def stdout(self) -> bytes:
+        return self._stdout.getvalue()
+
+    @property
+    def stderr(self) -> bytes:
+        return self._stderr.getvalue()
+
+    def wait_started(self, timeout: float = None) -> bool:
+        return self._started.wait(timeout)
+
+    def wait(self, timeout: float = None) -> bool:
+        """Blocks until process exits or timeout, returns False if still running."""
+        return self._exited.wait(timeout)
+
+    def is_alive(self) -> bool:
+        return self._started.is_set() and not self._exited.is_set()
+
+    def add_done_callback(self, fn):
+        """Calls `fn` from supervisor thread when process exits, at once if it exited already. It should not block."""
+        with self._lock:
+            if not self._exited.is_set():
+                self._callbacks.append(fn)
+                return
+        fn()
+
+    def every(self, interval: float, fn):
+        """Calls `fn` from supervisor thread every `interval` seconds while process runs. It should not block."""
+        def tick():
+            if self._exited.is_set():
+                return
+            try:
+                fn()
+            except Exception:
+                logger.exception("Supervisor: Process<%s> periodic callback failed." % self.pid)
+            self.loop.call_later(interval, tick)
+
+        self.loop.call_soon_threadsafe(self.loop.call_later, interval, tick)
+
+    def terminate(self):
+        """Stops the process on request, sets `terminated` so waiting side knows why it exited."""
+        if self.is_alive():
+            self.terminated = True
+            self.loop.call_soon_threadsafe(self._terminate)
+
+    def _signal(self, sig: int):
+        # Processes run in their own session, pid is also the group id so children are signalled too
+        try:
+            os.killpg(self.pid, sig)
+        except ProcessLookupError:
+            pass
+
+    def _terminate(self):
+        """Sends SIGINT, SIGTERM and SIGKILL in order, next one only if process did not exit in its grace period."""
+        if self._terminating_at is not None:
+            return
+        self._terminating_at = self.loop.time()
+        steps = [(signal.SIGINT, self.interrupt)] if self.interrupt is not None else []
+        steps += [(signal.SIGTERM, self.grace), (signal.SIGKILL, None)]
+        self._escalate(steps)
+
+    def _escalate(self, steps: list):
+        if self.returncode is not None or self._exited.is_set():
+            return
+        (sig, grace), steps = steps[0], steps[1:]
+        if sig == signal.SIGKILL:
+            logger.warning("Supervisor: Process<%d> did not exit, killing." % self.pid)
+        else:
+            logger.debug("Supervisor: Process<%d> sending %s." % (self.pid, signal.Signals(sig).name))
+        self._signal(sig)
+        if grace is not None and steps:
+            self.loop.call_later(grace, self._escalate, steps)
+
+    def _record_teardown(self):
+        if self._terminating_at is not None and self.teardown is None:
+            self.teardown = round(self.loop.time() - self._terminating_at, 3)
+
+    def _set_exited(self):
+        self._record_teardown()
+        with self._lock:
+            self._exited.set()
+            callbacks, self._callbacks = self._callbacks, []
+        for fn in callbacks:
+            try:
+                fn()
+            except Exception:
+                logger.exception("Supervisor: Process<%s> exit callback failed." % self.pid)
+
+
+class Supervisor:
+    def __init__(self, workers: int = 4):
+        """Owns child processes on a single asyncio loop running in its own thread.
+
+        :arg workers : Threads running blocking work of callers when their processes progress or exit, e.g. saving a
+            task, so no thread is kept waiting a process.
+        """
+        self.workers = workers
+        self.executor = None
+        self.loop = None
+        self.thread = None
+        self.handles = set()
+        self._lock = threading.Lock()
+
+    def is_running(self) -> bool:
+        return self.thread is not None and self.thread.is_alive()
+
+    def start(self):
+        """Starts the loop thread, can be called from any thread as children are not reaped by a child watcher."""
+        with self._lock:
+            if self.is_running():
+                return
+
+            self.loop = asyncio.new_event_loop()
+            self.executor = ThreadPoolExecutor(max_workers=self.workers, thread_name_prefix='Supervisor')
+            self.thread = threading.Thread(target=self._run, name='Supervisor', daemon=True)
+            self.thread.start()
+            logger.debug("Supervisor: Started.")
+
+    def _run(self):
+        asyncio.set_event_loop(self.loop)
+        self.loop.run_forever()
+
+    def stop(self):
+        """Stops supervising, running processes are left alive."""
+        if self.is_running():
+            self.loop.call_soon_threadsafe(self.loop.stop)
+            self.thread.join()
+            self.executor.shutdown(wait=False)
+            logger.debug("Supervisor: Stopped.")
+
+    def submit(self, fn, *args):
+        """Runs `fn` in a worker thread of the supervisor, e.g. from a callback which would block the loop."""
+        self.start()
+        return self.executor.submit(fn, *args)
+
+    def call_later(self, delay: float, fn, *args):
+        """Calls `fn` from supervisor thread after `delay` seconds, safe to call from any thread."""
+        self.start()
+        self.loop.call_soon_threadsafe(self.loop.call_later, delay, fn, *args)
+
+    def spawn(self, args: list, timeout: float = None, sink=None, tail: int = 4096, pipes: list = None,
+              name: str = None, interrupt: float = None, grace: float = None) -> ProcessHandle:
+        """Starts `args` without waiting it, process is terminated if it runs more than timeout seconds."""
+        self.start()
+        handle = ProcessHandle(args, timeout=timeout, sink=sink, tail=tail, pipes=pipes, name=name,
+                               interrupt=interrupt, grace=grace)
+        handle.loop = self.loop
+        asyncio.run_coroutine_threadsafe(self._supervise(handle), self.loop)
+        return handle
+
+    def adopt(self, pid: int, interval: float = 1, timeout: float = None, name: str = None, interrupt: float = None,
+              grace: float = None) -> ProcessHandle:
+        """Watches a process which is not a child anymore, e.g. started before daemon restarted.
+
+        Exit code of such a process can not be known, it is checked every `interval` seconds.
+        """
+        self.start()
+        handle = ProcessHandle(None, timeout=timeout, name=name, interrupt=interrupt, grace=grace)
+        handle.pid = pid
+        handle.loop = self.loop
+        handle._started.set()
+        asyncio.run_coroutine_threadsafe(self._watch(handle, interval), self.loop)
+        return handle
+
+    def find(self, name: str) -> ProcessHandle or None:
+        for handle in list(self.handles):
+            if handle.name == name:
+                return handle
+        return None
+
+    async def _watch(self, handle: ProcessHandle, interval: float):
+        self.handles.add(handle)
+        deadline = self.loop.time() + handle.timeout if handle.timeout is not None else None
+        try:
+            while pid_exists(handle.pid):
+                if deadline is not None and self.loop.time() >= deadline and not handle.timed_out:
+                    logger.warning("Supervisor: Process<%d> timeout, terminating." % handle.pid)
+                    handle.timed_out = True
+                    handle._terminate()
+                await asyncio.sleep(interval)
+        finally:
+            self.handles.discard(handle)
+            handle._set_exited()
+
+    @staticmethod
+    async def _drain(stream: asyncio.StreamReader, buffer: RingBuffer = None, sink=None):
+        while True:
+            chunk = await stream.read(CHUNK_SIZE)
+            if not chunk:
+                break
+            if buffer is not None:
+                buffer.write(chunk)
+            if sink:
+                try:
+                    sink(chunk)
+                except Exception:
+                    logger.exception("Supervisor: Output can not written to sink.")
+
+    async def _open_pipe(self, fd: int) -> asyncio.StreamReader:
+        reader = asyncio.StreamReader()
+        await self.loop.connect_read_pipe(lambda: asyncio.StreamReaderProtocol(reader), os.fdopen(fd, 'rb', 0))
+        return reader
+
+    def _reap(self, pid: int) -> asyncio.Future:
+        """Reaps the process on the loop without blocking, wait4 gives resource usage of it and children it waited.
+
+        Exit is noticed from a pidfd where kernel supports it, otherwise checked every REAP_INTERVAL seconds.
+        Result of the future is (returncode, usage).
+        """
+        future = self.loop.create_future()
+        pidfd = None
+        if hasattr(os, 'pidfd_open'):
+            try:
+                pidfd = os.pidfd_open(pid)
+            except OSError:
+                pidfd = None
+
+        def close():
+            if pidfd is not None:
+                self.loop.remove_reader(pidfd)
+                os.close(pidfd)
+
+        def check():
+            if future.done():
+                return
+            try:
+                reaped, status, usage = os.wait4(pid, os.WNOHANG)
+            except Exception as err:
+                close()
+                future.set_exception(err)
+                return
+            if not reaped:
+                if pidfd is None:
+                    self.loop.call_later(REAP_INTERVAL, check)
+                return
+            close()
+            returncode = -os.WTERMSIG(status) if os.WIFSIGNALED(status) else os.WEXITSTATUS(status)
+            future.set_result((returncode, usage))
+
+        if pidfd is not None:
+            self.loop.add_reader(pidfd, check)
+        # Process may have exited already
+        check()
+        return future
+
+    async def _supervise(self, handle: ProcessHandle):
+        stdout, stderr = os.pipe(), os.pipe()
+        pipes = [(stdout[0], stdout[1], None), (stderr[0], stderr[1], None)] + handle.pipes
+        started = self.loop.time()
+        try:
+            handle.process = subprocess.Popen(handle.args, stdout=stdout[1], stderr=stderr[1], start_new_session=True,
+                                              pass_fds=tuple(write_fd for _, write_fd, _ in handle.pipes))
+        except Exception as err:
+            logger.exception("Supervisor: Process can not started: %s" % handle.args)
+            for read_fd, _, _ in pipes:
+                os.close(read_fd)
+            handle.error = err
+            handle._started.set()
+            handle._set_exited()
+            return
+        finally:
+            # Only the process writes, so reader sees end of file when it exits
+            for _, write_fd, _ in pipes:
+                try:
+                    os.close(write_fd)
+                except OSError:
+                    pass
+
+        handle.pid = handle.process.pid
+        self.handles.add(handle)
+        handle._started.set()
+        try:
+            # Pipes are read as soon as data arrives so process never blocks on a full pipe
+            drains = [self._drain(await self._open_pipe(stdout[0]), handle._stdout, handle.sink),
+                      self._drain(await self._open_pipe(stderr[0]), handle._stderr, handle.sink)]
+            for read_fd, _, sink in handle.pipes:
+                drains.append(self._drain(await self._open_pipe(read_fd), sink=sink))
+            drains = asyncio.gather(*drains)
+            wait = self._reap(handle.pid)
+            done, _ = await asyncio.wait([wait], timeout=handle.timeout)
+            if not done:
+                logger.warning("Supervisor: Process<%d> timeout, terminating." % handle.pid)
+                handle.timed_out = True
+                handle._terminate()
+            handle.returncode, usage = await wait
+            # Process is reaped already, Popen should not wait it again
+            handle.process.returncode = handle.returncode
+            handle.usage = {'cpu_user': usage.ru_utime, 'cpu_system': usage.ru_stime, 'max_rss': usage.ru_maxrss,
+                            'block_in': usage.ru_inblock, 'block_out': usage.ru_oublock,
+                            'wall_time': round(self.loop.time() - started, 3)}
+            handle._record_teardown()
+            await drains
+        except Exception as err:
+            logger.exception("Supervisor: Process<%d> supervise failed." % handle.pid)
+            handle.error = err
+        finally:
+            self.handles.discard(handle)
+            handle._set_exited()
+
+
+# Shared by every task of the process, started lazily.
+supervisor = Supervisor()
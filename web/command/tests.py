@@ -1,6 +1,27 @@
-from django.test import TestCase
-from command.models import Queue, Task, TaskStatus
+import os
+import signal
+import tempfile
+import threading
+from datetime import datetime, timedelta
+from queue import Queue as CallQueue
+from urllib.request import urlopen
+
+from django.conf import settings
+from django.contrib.auth import get_user_model
+from django.db.models.signals import post_save
+from django.test import TestCase, override_settings
+from command.models import Queue, QueueStatus, ResourceClass, Task, TaskStatus
+from command.daemon import Daemon
 from command.errors import DependenceError, CommandError
+from command.logs import log_files
+from command.metrics import MetricsServer, Registry
+from command.policy import Policy
+from command.progress import ProgressSeries, is_ffmpeg, with_progress, without_progress
+from command.scheduler import DeadlineHeap
+from command.supervisor import supervisor
+from command.utils import get_cmdline, is_command_process
+
+User = get_user_model()
 
 
 class TaskTestCase(TestCase):
@@ -45,11 +66,105 @@ class TaskTestCase(TestCase):
         t2.run()
         self.assertEqual(t2._get_self().status, TaskStatus.Completed)
 
+    def test_task_log(self):
+        task = self.create_task(command="echo 'Out' && echo 'Err' >&2")
+        task.run()
+        task = task._get_self()
+        self.assertEqual(task.stdout, "Out\n")
+        self.assertEqual(task.stderr, "Err\n")
+        self.assertIn("Err", task.read_log())
+        task.delete()
+
+    def test_delete_log(self):
+        task = self.create_task(command="echo 'Test'")
+        task.run()
+        log = task._get_self().log
+        self.assertTrue(log_files(log))
+        Task.objects.filter(id=task.id).delete()
+        self.assertEqual(log_files(log), [])
+
+    def test_transition(self):
+        task = self.create_task(command="echo 'Test'")
+        saves = []
+        post_save.connect(lambda update_fields, **kwargs: saves.append(update_fields), sender=Task, weak=False,
+                          dispatch_uid='test_transition')
+        try:
+            task.run()
+        finally:
+            post_save.disconnect(sender=Task, dispatch_uid='test_transition')
+        # Processing and Completed steps, each in one save
+        self.assertEqual(len(saves), 2)
+        task = task._get_self()
+        self.assertEqual(task.status, TaskStatus.Completed)
+        self.assertIsNotNone(task.pid)
+        self.assertIsNotNone(task.started_at)
+        self.assertIsNotNone(task.ended_at)
+
     def test_error_task(self):
         task = self.create_task(command="echo 'Error' && exit 1")
         task.run()
         self.assertEqual(task._get_self().status, TaskStatus.Error)
 
+    def test_task_usage(self):
+        task = self.create_task(command="echo 'Test'")
+        task.run()
+        task = task._get_self()
+        self.assertIsNotNone(task.cpu_user)
+        self.assertIsNotNone(task.cpu_system)
+        self.assertGreater(task.max_rss, 0)
+        self.assertGreater(task.wall_time, 0)
+
+    def test_task_without_shell(self):
+        task = self.create_task(command="echo 'Out' '$HOME'", shell=False)
+        task.run()
+        self.assertEqual(task._get_self().stdout, "Out $HOME\n")
+
+    @override_settings(TASK_RESTART_BACKOFF=0.1, TASK_RESTART_BUDGET=1)
+    def test_restart_task(self):
+        # Fails on first run only
+        mark = os.path.join(tempfile.mkdtemp(), 'mark')
+        task = self.create_task(command="test -f %s || (touch %s && exit 1)" % (mark, mark), restart=True)
+        task.run()
+        task = task._get_self()
+        self.assertEqual(task.status, TaskStatus.Completed)
+        self.assertEqual(task.restarts, 1)
+
+    @override_settings(TASK_RESTART_BACKOFF=0.1, TASK_RESTART_BUDGET=0.35)
+    def test_restart_budget(self):
+        # Waits 0.1 and 0.2 seconds, third wait of 0.4 seconds is over budget
+        task = self.create_task(command="exit 1", restart=True)
+        task.run()
+        task = task._get_self()
+        self.assertEqual(task.status, TaskStatus.Error)
+        self.assertEqual(task.restarts, 2)
+
+    def test_timeout_task(self):
+        task = self.create_task(command="sleep 30", timeout="00:00:01")
+        task.run()
+        task = task._get_self()
+        self.assertEqual(task.status, TaskStatus.Terminated)
+        self.assertLess((task.ended_at - task.started_at).total_seconds(), 5)
+        self.assertIsNotNone(task.teardown)
+
+    def test_large_pid(self):
+        task = self.create_task(command="echo 'Test'", pid=4194304)
+        self.assertEqual(task._get_self().pid, 4194304)
+
+    def test_start_without_threads(self):
+        tasks = [self.create_task(command="sleep 0.5") for _ in range(10)]
+        supervisor.start()
+        threads = threading.active_count()
+        # Steps after start are run here, test database is not visible to other threads
+        calls = CallQueue()
+        futures = [task.start(submit=calls.put) for task in tasks]
+        # No thread waits a process
+        self.assertEqual(threading.active_count(), threads)
+        while not all(future.done() for future in futures):
+            calls.get(timeout=10)()
+        self.assertEqual(threading.active_count(), threads)
+        for task in tasks:
+            self.assertEqual(task._get_self().status, TaskStatus.Completed)
+
 
 class QueueTestCase(TestCase):
     @staticmethod
@@ -100,3 +215,268 @@ class QueueTestCase(TestCase):
         q.add(t5)
         q.add(t4)
         self.assertEqual([t1.id, t2.id, t5.id, t3.id, t4.id], [t.id for t in q.tasks()])
+
+    def test_ready_tasks(self):
+        q = self.create_queue()
+        t1 = self.create_task(command="echo 'Record'")
+        t2 = self.create_task(command="echo 'Resize'", depends=t1)
+        t3 = self.create_task(command="echo 'Thumbnail'")
+        t3.requires.add(t1)
+        t4 = self.create_task(command="echo 'Publish'")
+        t4.requires.add(t2, t3)
+        q.add(t4)
+        self.assertEqual([t1.id], [t.id for t in q.ready_tasks()])
+
+        t1.set_status_completed()
+        self.assertEqual([t2.id, t3.id], [t.id for t in q.ready_tasks()])
+
+        q.start()
+        self.assertEqual(t4._get_self().status, TaskStatus.Completed)
+
+    def test_failed_branch_status(self):
+        q = self.create_queue()
+        t1 = self.create_task(command="echo 'Record'")
+        t2 = self.create_task(command="echo 'Resize'", depends=t1)
+        t3 = self.create_task(command="echo 'Thumbnail'")
+        t3.requires.add(t1)
+        q.add(t2, t3)
+        q.begin()
+        t1.set_status_completed()
+        t2.set_status_processing()
+        t2.set_status_error()
+        # Sibling branch is still to run, e.g. waiting for a free worker
+        self.assertEqual(q._get_self().status, QueueStatus.Processing)
+        t3.set_status_processing()
+        self.assertEqual(q._get_self().status, QueueStatus.Processing)
+        t3.set_status_completed()
+        self.assertEqual(q._get_self().status, QueueStatus.Error)
+
+    def test_claim(self):
+        q = self.create_queue()
+        self.assertTrue(Queue.claim(q.id, 'node-a', 60))
+        self.assertTrue(Queue.claim(q.id, 'node-a', 60))
+        self.assertFalse(Queue.claim(q.id, 'node-b', 60))
+
+        # Lease expired
+        Queue.objects.filter(id=q.id).update(lease_expires=datetime.now() - timedelta(seconds=1))
+        self.assertTrue(Queue.claim(q.id, 'node-b', 60))
+        self.assertEqual(q._get_self().node, 'node-b')
+
+    def test_save_queued_task(self):
+        q = self.create_queue()
+        task = self.create_task(command="echo 'Test'")
+        q.add(task)
+        task.set_status_completed()
+        task.save()
+        self.assertEqual(q._get_self().status, QueueStatus.Completed)
+
+    def test_queue_status(self):
+        q = self.create_queue()
+        t1, t2 = self.create_task(command="echo 'T1'"), self.create_task(command="echo 'T2'")
+        q.add(t1, t2)
+        t1.set_status_completed()
+        with self.assertNumQueries(1):
+            counts = q.count_tasks()
+        self.assertEqual(counts, {'total': 2, 'error': 0, 'terminated': 0, 'completed': 1, 'processing': 0})
+
+        t2.set_status_error()
+        self.assertEqual(q._get_self().status, QueueStatus.Error)
+
+    def test_terminated_queue_status(self):
+        q = self.create_queue(node='node-a')
+        t1 = self.create_task(command="sleep 30", timeout="00:00:01")
+        t2 = self.create_task(command="echo 'T2'", depends=t1)
+        q.add(t1, t2)
+        q.start()
+        self.assertEqual(t1._get_self().status, TaskStatus.Terminated)
+        # Queue ends, so its lease is not renewed anymore
+        self.assertEqual(q._get_self().status, QueueStatus.Stopped)
+        self.assertEqual(Queue.renew_leases('node-a', 60), 0)
+
+
+class DeadlineHeapTestCase(TestCase):
+    def test_pop_due(self):
+        now = datetime.now()
+        heap = DeadlineHeap()
+        heap.push(1, now + timedelta(seconds=10))
+        heap.push(2, now - timedelta(seconds=1))
+        heap.push(3)
+        self.assertEqual(heap.pop_due(now), [3, 2])
+        self.assertEqual(heap.next_deadline(), now + timedelta(seconds=10))
+        self.assertEqual(len(heap), 1)
+
+    def test_reschedule_and_discard(self):
+        now = datetime.now()
+        heap = DeadlineHeap()
+        heap.push(1, now - timedelta(seconds=5))
+        heap.push(2, now - timedelta(seconds=5))
+        heap.push(1, now + timedelta(seconds=5))
+        heap.discard(2)
+        self.assertEqual(heap.pop_due(now), [])
+        self.assertEqual(heap.next_deadline(), now + timedelta(seconds=5))
+
+
+class UtilsTestCase(TestCase):
+    def test_is_command_process(self):
+        cmdline = get_cmdline(os.getpid())
+        self.assertTrue(cmdline)
+        self.assertTrue(is_command_process(os.getpid(), cmdline))
+        self.assertFalse(is_command_process(os.getpid(), ['ffmpeg', '-i', 'input', 'output']))
+        self.assertFalse(is_command_process(-1, ['ffmpeg']))
+
+
+class SupervisorTestCase(TestCase):
+    def test_terminate(self):
+        # Shell ignores SIGTERM, so process group is killed after grace
+        handle = supervisor.spawn(['/bin/sh', '-c', 'trap "" TERM; sleep 30'], name='test_terminate', grace=0.5)
+        handle.wait_started()
+        supervisor.find('test_terminate').terminate()
+        self.assertTrue(handle.wait(5))
+        self.assertTrue(handle.terminated)
+        self.assertEqual(handle.returncode, -signal.SIGKILL)
+
+    def test_reap_without_threads(self):
+        supervisor.start()
+        threads = threading.active_count()
+        handles = [supervisor.spawn(['/bin/sh', '-c', 'sleep 0.5; exit 3']) for _ in range(10)]
+        for handle in handles:
+            handle.wait_started()
+        self.assertEqual(threading.active_count(), threads)
+        for handle in handles:
+            self.assertTrue(handle.wait(5))
+            self.assertEqual(handle.returncode, 3)
+            self.assertIsNotNone(handle.usage)
+
+    def test_large_output(self):
+        # Both streams overflow a 64 KiB pipe buffer, nothing but the supervisor reads them
+        handle = supervisor.spawn(['/bin/sh', '-c', 'head -c 200000 /dev/zero; head -c 200000 /dev/zero >&2'],
+                                  tail=4096)
+        self.assertTrue(handle.wait(10))
+        self.assertEqual(handle.returncode, 0)
+        self.assertEqual(len(handle.stdout), 4096)
+        self.assertEqual(len(handle.stderr), 4096)
+
+
+class PolicyTestCase(TestCase):
+    def test_apply(self):
+        policy = Policy(nice=10, threads=2)
+        self.assertEqual(policy.apply(['ffmpeg', '-i', 'input', 'output'], ffmpeg=True),
+                         ['nice', '-n', '10', 'ffmpeg', '-i', 'input', '-threads', '2', 'output'])
+        # Before every output, values of options are not taken as outputs
+        self.assertEqual(policy.adjust(['ffmpeg', '-y', '-i', 'input', '-map', '[o0]', 'a.mp4', '-map', '[o1]',
+                                        'b.mp4'], ffmpeg=True),
+                         ['ffmpeg', '-y', '-i', 'input', '-map', '[o0]', '-threads', '2', 'a.mp4', '-map', '[o1]',
+                          '-threads', '2', 'b.mp4'])
+        self.assertEqual(Policy().apply(['echo', 'Test']), ['echo', 'Test'])
+
+
+class MetricsTestCase(TestCase):
+    def test_render(self):
+        registry = Registry()
+        registry.counter('test_total', 'Test counter.', labels=('kind',)).inc(2, kind='a')
+        registry.histogram('test_seconds', 'Test histogram.', buckets=(1, 2)).observe(1.5)
+        text = registry.render()
+        self.assertIn('test_total{kind="a"} 2.0', text)
+        self.assertIn('test_seconds_bucket{le="1.0"} 0', text)
+        self.assertIn('test_seconds_bucket{le="+Inf"} 1', text)
+        self.assertIn('test_seconds_count 1', text)
+
+    @override_settings(METRICS_TOKEN='secret')
+    def test_view(self):
+        Queue.objects.create()
+        # Labels name channels, anonymous requests are refused
+        self.assertEqual(self.client.get('/metrics').status_code, 403)
+        self.assertEqual(self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer wrong').status_code, 403)
+        response = self.client.get('/metrics', HTTP_AUTHORIZATION='Bearer secret')
+        self.assertEqual(response.status_code, 200)
+        self.assertIn(b'command_queues', response.content)
+
+        User.objects.create_user(username='staff', password='staff', is_staff=True)
+        self.client.login(username='staff', password='staff')
+        self.assertEqual(self.client.get('/metrics').status_code, 200)
+
+    def test_server(self):
+        registry = Registry()
+        registry.counter('test_total', 'Test counter.').inc()
+        server = MetricsServer(registry, 0)
+        server.start()
+        try:
+            # Not reachable from other hosts unless an address is given
+            self.assertEqual(server.server.server_address[0], '127.0.0.1')
+            with urlopen('http://127.0.0.1:%d/metrics' % server.server.server_port, timeout=5) as response:
+                self.assertIn(b'test_total 1.0', response.read())
+        finally:
+            server.stop()
+
+
+class ProgressTestCase(TestCase):
+    def test_feed(self):
+        series = ProgressSeries(max_points=2)
+        for i in range(1, 4):
+            series.feed(b'frame=%d\nbitrate=N/A\nout_time_us=%d000000\nspeed=1.5x\nprogress=continue\n' % (i, i))
+        series.feed(b'frame=4\nout_time_us=4000000\nprogress=end\n')
+        data = series.to_json()
+        self.assertEqual(data['frame'], [1.0, 3.0])
+        self.assertEqual(data['bitrate'], [None, None])
+        self.assertEqual(data['last'], {'frame': 4.0, 'out_time': 4.0})
+        self.assertTrue(data['ended'])
+
+    def test_with_progress(self):
+        self.assertTrue(is_ffmpeg("/usr/bin/ffmpeg -i input output"))
+        self.assertFalse(is_ffmpeg("echo 'ffmpeg'"))
+        self.assertEqual(with_progress("ffmpeg -i input output", 3), "ffmpeg -progress pipe:3 -i input output")
+        self.assertEqual(without_progress("ffmpeg -progress pipe:3 -i input output"), "ffmpeg -i input output")
+        self.assertEqual(without_progress("ffmpeg -progress pipe:3 -i input -threads 2 output"),
+                         "ffmpeg -i input -threads 2 output")
+
+    def test_percent(self):
+        task = Task.objects.create(duration=10, progress={'last': {'out_time': 2.5, 'speed': 1.0}})
+        self.assertEqual(task.percent(), 25.0)
+        self.assertEqual(task.speed(), 1.0)
+
+
+class DaemonTestCase(TestCase):
+    @override_settings(TASK_POLICIES={'cpu': {'nice': 10, 'threads': 2}})
+    def test_recover_with_threads(self):
+        q = Queue.objects.create(status=QueueStatus.Processing.value, node=settings.DAEMON_NODE)
+        task = Task.objects.create(queue=q, resource=ResourceClass.CPU.value,
+                                   command="ffmpeg -nostdin -f lavfi -i anullsrc -f null -")
+        task._start_process()
+        daemon = Daemon()
+        try:
+            self.assertIn('-threads', get_cmdline(task.pid))
+            daemon.recover()
+            # Process is recognized from the argv it was started with, not taken as lost
+            self.assertIn(task.id, daemon.running)
+            self.assertEqual(task._get_self().status, TaskStatus.Processing)
+        finally:
+            task.ps.terminate()
+            task.ps.wait(5)
+            task._log.close()
+            for pool in daemon.pools.values():
+                pool.shutdown(wait=False)
+
+    def test_takeover(self):
+        q = Queue.objects.create(status=QueueStatus.Processing.value, node='node-a',
+                                 lease_expires=datetime.now() - timedelta(seconds=1))
+        t1 = Task.objects.create(command="echo 'T1'")
+        t2 = Task.objects.create(command="sleep 30", depends=t1)
+        q.add(t2)
+        t1.set_status_completed()
+        t2.transition(TaskStatus.Processing, pid=1, started_at=datetime.now())
+        daemon = Daemon()
+        daemon.node = 'node-b'
+        try:
+            daemon.renew()
+        finally:
+            for pool in daemon.pools.values():
+                pool.shutdown(wait=False)
+        q = q._get_self()
+        self.assertEqual(q.node, 'node-b')
+        self.assertEqual(q.status, QueueStatus.Processing)
+        # Interrupted task runs again on the new node, completed one is kept
+        t2 = t2._get_self()
+        self.assertEqual(t2.status, TaskStatus.Created)
+        self.assertIsNone(t2.pid)
+        self.assertEqual(t1._get_self().status, TaskStatus.Completed)
+        self.assertIn(q.id, daemon.waiting)
@@ -1,4 +1,5 @@
 import os
+import shlex
 
 
 # https://stackoverflow.com/questions/568271/how-to-check-if-there-exists-a-process-with-a-given-pid-in-python
@@ -12,3 +13,51 @@ def pid_exists(pid):
         return True  # Operation not permitted (i.e., process exists)
     else:
         return True  # no error, we can send a signal to the process
+
+
+def get_cmdline(pid: int) -> list:
+    """Arguments of a running process from /proc, empty if process not exists or not readable."""
+    try:
+        with open('/proc/%d/cmdline' % pid, 'rb') as f:
+            return [arg.decode('utf-8', 'replace') for arg in f.read().split(b'\0') if arg]
+    except (OSError, ValueError):
+        return []
+
+
+def is_command_process(pid: int, args: list, normalize=None) -> bool:
+    """Checks process is running the argv so a reused pid is not mistaken for it.
+
+    :arg normalize : Applied to the running command line before comparing, e.g. to drop options added when started.
+    """
+    cmdline = get_cmdline(pid)
+    if not cmdline:
+        return False
+    normalize = normalize or (lambda value: value)
+    return shlex.split(normalize(' '.join(shlex.quote(arg) for arg in cmdline))) == args
+
+
+def merge_usage(total: dict or None, usage: dict or None) -> dict or None:
+    """Resource usage of processes run one after another, peak memory is the largest one."""
+    if not total or not usage:
+        return usage or total
+    merged = {key: total.get(key, 0) + value for key, value in usage.items()}
+    merged['max_rss'] = max(total.get('max_rss', 0), usage.get('max_rss', 0))
+    return merged
+
+
+class RingBuffer:
+    def __init__(self, size: int):
+        """Keeps only last `size` bytes written, memory stays constant however much is written."""
+        self.size = size
+        self.data = bytearray()
+
+    def __len__(self):
+        return len(self.data)
+
+    def write(self, chunk: bytes):
+        self.data += chunk[-self.size:]
+        if len(self.data) > self.size:
+            del self.data[:len(self.data) - self.size]
+
+    def getvalue(self) -> bytes:
+        return bytes(self.data)
@@ -0,0 +1,74 @@
+import hmac
+
+from django.conf import settings
+from django.contrib.admin.views.decorators import staff_member_required
+from django.db.models import Count
+from django.http import HttpResponse, HttpResponseForbidden, JsonResponse
+from django.shortcuts import get_object_or_404
+from django.utils import timezone
+
+from .metrics import CONTENT_TYPE, DURATION_BUCKETS, Registry, collectors, register_collector
+from .models import Queue, QueueStatus, Task, TaskStatus
+
+
+def _is_metrics_allowed(request) -> bool:
+    """Staff users or a scraper sending METRICS_TOKEN as a bearer token."""
+    if request.user.is_active and request.user.is_staff:
+        return True
+    token = settings.METRICS_TOKEN
+    authorization = request.META.get('HTTP_AUTHORIZATION', '')
+    return bool(token) and hmac.compare_digest(authorization.encode(), ('Bearer %s' % token).encode())
+
+
+def metrics(request):
+    """Database derived metrics in Prometheus text format, daemons serve their own on DAEMON_METRICS_PORT.
+
+    Labels name channels, so they are not public.
+    """
+    if not _is_metrics_allowed(request):
+        return HttpResponseForbidden()
+    registry = Registry()
+    for collector in collectors:
+        collector(registry)
+    return HttpResponse(registry.render(), content_type=CONTENT_TYPE)
+
+
+@staff_member_required
+def task_progress(request, id):
+    """Progress time series of a task, updated while the process runs."""
+    task = get_object_or_404(Task, id=id)
+    return JsonResponse({'id': task.id, 'status': task.get_status_display(), 'percent': task.percent(),
+                         'speed': task.speed(), 'progress': task.progress})
+
+
+def _since():
+    return timezone.now() - timezone.timedelta(seconds=settings.METRICS_WINDOW)
+
+
+@register_collector
+def collect_queues(registry: Registry):
+    names = dict(QueueStatus.choices())
+    queues = registry.gauge('command_queues', 'Queues by status.', labels=('status',))
+    for row in Queue.objects.values('status').annotate(count=Count('id')).order_by():
+        queues.set(row['count'], status=names.get(row['status'], row['status']))
+
+    lag = registry.histogram('command_dispatch_lag_seconds',
+                             'Delay between queue timer and queue start, for queues started in metrics window.')
+    started = Queue.objects.all().filter(started_at__gte=_since(), timer__isnull=False)
+    for timer, started_at in started.values_list('timer', 'started_at'):
+        lag.observe(max((started_at - timer).total_seconds(), 0))
+
+
+@register_collector
+def collect_tasks(registry: Registry):
+    names = dict(TaskStatus.choices())
+    tasks = registry.gauge('command_tasks', 'Tasks by status and resource class, Processing ones are running '
+                                            'processes.', labels=('status', 'resource'))
+    for row in Task.objects.values('status', 'resource').annotate(count=Count('id')).order_by():
+        tasks.set(row['count'], status=names.get(row['status'], row['status']), resource=row['resource'])
+
+    duration = registry.histogram('command_task_duration_seconds', 'Run time of tasks ended in metrics window.',
+                                  labels=('resource',), buckets=DURATION_BUCKETS)
+    ended = Task.objects.all().filter(ended_at__gte=_since(), started_at__isnull=False)
+    for resource, started_at, ended_at in ended.values_list('resource', 'started_at', 'ended_at'):
+        duration.observe((ended_at - started_at).total_seconds(), resource=resource)
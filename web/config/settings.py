@@ -11,6 +11,7 @@ https://docs.djangoproject.com/en/1.11/ref/settings/
 """
 
 import os
+import socket
 
 import environ
 from django.utils.translation import ugettext_lazy as _
@@ -150,6 +151,34 @@ if not os.path.exists(LOG_DIR):  # Create Log Dir if not exists
     except:
         pass
 
+# Task process output is written to a log file per task, rotated at TASK_LOG_MAX_BYTES and gzipped when process ends.
+# Only last TASK_LOG_TAIL bytes are kept in database.
+TASK_LOG_DIR = os.path.join(LOG_DIR, 'tasks')
+TASK_LOG_MAX_BYTES = env.int("TASK_LOG_MAX_BYTES", 10 * 1024 * 1024)
+TASK_LOG_BACKUP_COUNT = env.int("TASK_LOG_BACKUP_COUNT", 2)
+TASK_LOG_COMPRESS = env.bool("TASK_LOG_COMPRESS", True)
+TASK_LOG_TAIL = env.int("TASK_LOG_TAIL", 4096)
+# Terminated or timed out task processes get SIGINT first so ffmpeg can finalize output, SIGTERM after
+# TASK_INTERRUPT_GRACE seconds and SIGKILL after TASK_KILL_GRACE more seconds.
+TASK_INTERRUPT_GRACE = env.int("TASK_INTERRUPT_GRACE", 10)
+TASK_KILL_GRACE = env.int("TASK_KILL_GRACE", 10)
+# Points kept in progress time series of ffmpeg tasks, older points are thinned out when reached.
+TASK_PROGRESS_POINTS = env.int("TASK_PROGRESS_POINTS", 720)
+# Restartable tasks are started again TASK_RESTART_BACKOFF seconds after their process fails, the wait is doubled on
+# every restart and a task is not restarted once total wait would exceed TASK_RESTART_BUDGET seconds.
+TASK_RESTART_BACKOFF = env.float("TASK_RESTART_BACKOFF", 1)
+TASK_RESTART_BUDGET = env.float("TASK_RESTART_BUDGET", 60)
+# Segmented recordings are written as chunks of RECORD_SEGMENT_SECONDS, finished chunks survive a failed recording.
+RECORD_SEGMENT_SECONDS = env.int("RECORD_SEGMENT_SECONDS", 60)
+# Schedules of a channel with overlapping windows share one recording of the stream, each cuts its window from it.
+RECORD_SHARED_INGEST = env.bool("RECORD_SHARED_INGEST", False)
+# HLS master playlists of channels are resolved to the variant recorded when a recording starts, kept for
+# RECORD_STREAM_TTL seconds per channel. 0 disables resolving.
+RECORD_STREAM_TTL = env.int("RECORD_STREAM_TTL", 300)
+
+# Recordings found late with less than RECORD_MIN_SECONDS of their window left are timed out instead of started
+RECORD_MIN_SECONDS = env.int("RECORD_MIN_SECONDS", 10)
+
 LOGGING = {
     'version': 1,
     'disable_existing_loggers': False,
@@ -230,6 +259,66 @@ LOGGING = {
     }
 }
 
+# Daemon
+
+# Worker pool of each task resource class; how many tasks can run at the same time, and how many more can wait for a
+# free worker. Stream copy recordings (io) never wait behind transcodes (cpu), transcodes are limited by core count.
+DAEMON_POOLS = {
+    'io': {
+        'workers': env.int("DAEMON_MAX_WORKERS", 20),
+        'backlog': env.int("DAEMON_BACKLOG", 20),
+    },
+    'cpu': {
+        'workers': env.int("DAEMON_MAX_TRANSCODES", os.cpu_count() or 1),
+        'backlog': env.int("DAEMON_TRANSCODE_BACKLOG", 100),
+    },
+}
+
+# Execution policy of each resource class: CPU list in taskset format, niceness, IO class as 'class[:level]' for
+# ionice and ffmpeg thread count, 0 leaves it to ffmpeg. By default transcodes yield CPU and disk to recordings.
+TASK_POLICIES = {
+    'io': {
+        'cpus': env.str("TASK_IO_CPUS", ""),
+        'nice': env.int("TASK_IO_NICE", 0),
+        'ionice': env.str("TASK_IO_IONICE", ""),
+        'threads': 0,
+    },
+    'cpu': {
+        'cpus': env.str("TASK_CPU_CPUS", ""),
+        'nice': env.int("TASK_CPU_NICE", 10),
+        'ionice': env.str("TASK_CPU_IONICE", "best-effort:7"),
+        'threads': env.int("TASK_CPU_THREADS", 0),
+    },
+}
+
+# Queues found late start at once, tasks can shorten their work to the time left. Ones later than DAEMON_LATE_CUTOFF
+# seconds are timed out.
+DAEMON_LATE_CUTOFF = env.int("DAEMON_LATE_CUTOFF", 300)
+# Queues are started DAEMON_PREROLL seconds before their timer, recordings extend to cover it so connecting to the
+# stream does not cut their beginning.
+DAEMON_PREROLL = env.int("DAEMON_PREROLL", 5)
+# Queues are prepared DAEMON_PREPARE seconds before they are started, e.g. recordings resolve their stream, so it is
+# not done within the pre-roll. Should be less than RECORD_STREAM_TTL, 0 disables.
+DAEMON_PREPARE = env.int("DAEMON_PREPARE", 30)
+
+# Daemons on different hosts can share the database, each one claims queues under its node name for DAEMON_LEASE
+# seconds and renews the lease while working. Queues of a node which stops renewing are taken over by others.
+DAEMON_NODE = env.str("DAEMON_NODE", socket.gethostname())
+DAEMON_LEASE = env.int("DAEMON_LEASE", 60)
+
+# Metrics
+
+# Daemon serves its own metrics on this port, 0 disables. They are not authenticated, so they are served on loopback
+# only unless DAEMON_METRICS_HOST is set, e.g. to 0.0.0.0 for a scraper on another host.
+DAEMON_METRICS_PORT = env.int("DAEMON_METRICS_PORT", 9108)
+DAEMON_METRICS_HOST = env.str("DAEMON_METRICS_HOST", "127.0.0.1")
+
+# Seconds to look back for durations and lags on /metrics
+METRICS_WINDOW = env.int("METRICS_WINDOW", 3600)
+# /metrics names channels, it is served to staff users and to scrapers sending "Authorization: Bearer METRICS_TOKEN".
+# Empty token allows staff only.
+METRICS_TOKEN = env.str("METRICS_TOKEN", "")
+
 # Translations
 LOCALE_PATHS = (
     os.path.join(BASE_DIR, 'locale'),
@@ -18,7 +18,11 @@ from django.contrib import admin
 from django.conf.urls.static import static
 from django.conf import settings
 
+from command.views import metrics, task_progress
+
 urlpatterns = [
+    url(r'^metrics$', metrics, name='metrics'),
+    url(r'^tasks/(?P<id>\d+)/progress$', task_progress, name='task-progress'),
     url(r'', admin.site.urls),
 
 ] + static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
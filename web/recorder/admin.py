@@ -3,7 +3,7 @@ from django.contrib import admin
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
-from .models import Category, Channel, Schedule, Video
+from .models import Category, Channel, Ingest, Schedule, Segment, Video
 
 
 def delete_model(modeladmin, request, queryset):
@@ -34,6 +34,14 @@ class ChannelAdmin(admin.ModelAdmin):
 admin.site.register(Channel, ChannelAdmin)
 
 
+class SegmentInline(admin.TabularInline):
+    model = Segment
+    extra = 0
+    can_delete = False
+    fields = ('index', 'file', 'start', 'end', 'size')
+    readonly_fields = fields
+
+
 class ScheduleAdminForm(forms.ModelForm):
     def clean_start_time(self):
         start_time = self.cleaned_data['start_time']
@@ -51,16 +59,18 @@ class ScheduleAdmin(admin.ModelAdmin):
 
     fieldsets = (
         (_('Record Informations'), {
-            'fields': ('channel', 'name', 'start_time', 'time', 'file', 'status', 'created_at')
+            'fields': ('channel', 'name', 'start_time', 'time', 'segmented', 'file', 'status', 'lateness',
+                       'created_at')
         }),
         (_('Resize'), {
-            'fields': ('resize', 'foar')
+            'fields': ('resize', 'foar', 'live_resize', 'renditions', 'keep_original')
         })
     )
     form = ScheduleAdminForm
     actions = [delete_model]
+    inlines = [SegmentInline]
 
-    readonly_fields = ('created_at', 'updated_at', 'status', 'file', 'user', 'queue')
+    readonly_fields = ('created_at', 'updated_at', 'status', 'lateness', 'file', 'user', 'queue', 'ingest')
 
     def get_changeform_initial_data(self, request):
         return {'time': '00:01:00', 'start_time': timezone.now(), 'channel': Channel.objects.all().first()}
@@ -76,11 +86,20 @@ class ScheduleAdmin(admin.ModelAdmin):
 admin.site.register(Schedule, ScheduleAdmin)
 
 
+class IngestAdmin(admin.ModelAdmin):
+    list_display = ['id', 'channel', 'start_time', 'end_time', 'queue']
+    list_filter = ['channel']
+    readonly_fields = ('channel', 'start_time', 'end_time', 'queue', 'created_at')
+
+
+admin.site.register(Ingest, IngestAdmin)
+
+
 class VideoAdmin(admin.ModelAdmin):
     list_display = ['id', 'name', 'format', 'size']
     list_filter = ['format']
     readonly_fields = (
-        'related_content_type', 'related_object_id', 'related', 'created_at', 'updated_at', 'attr',
+        'related_content_type', 'related_object_id', 'related', 'created_at', 'updated_at', 'attr', 'gaps',
         'format', 'name', 'file')
 
     actions = [delete_model]
@@ -7,4 +7,5 @@ class RecorderConfig(AppConfig):
 
     def ready(self):
         import recorder.signals.handlers  #noqa
+        import recorder.metrics  #noqa
         pass
@@ -0,0 +1,62 @@
+import os
+
+from django.conf import settings
+from django.db.models import Count, F, Max, Sum
+from django.utils import timezone
+
+from command.metrics import BYTES_BUCKETS, SECONDS_BUCKETS, Registry, register_collector
+from command.models import Task
+from recorder.models import Schedule, ScheduleStatus
+
+
+@register_collector
+def collect_recordings(registry: Registry):
+    size = registry.histogram('recorder_recording_bytes', 'Bytes written per recording completed in metrics window.',
+                              buckets=BYTES_BUCKETS)
+    since = timezone.now() - timezone.timedelta(seconds=settings.METRICS_WINDOW)
+    completed = Schedule.objects.all().filter(status=ScheduleStatus.Completed.value, updated_at__gte=since)
+    for schedule in completed.exclude(file=''):
+        try:
+            size.observe(os.path.getsize(schedule.file.path))
+        except OSError:
+            pass
+
+
+@register_collector
+def collect_lateness(registry: Registry):
+    """How late recordings started in metrics window, 0 for the ones started on time."""
+    lateness = registry.histogram('recorder_start_lateness_seconds', 'Delay between schedule start and recording.',
+                                  buckets=SECONDS_BUCKETS + (120, 300))
+    since = timezone.now() - timezone.timedelta(seconds=settings.METRICS_WINDOW)
+    started = Schedule.objects.all().filter(start_time__gte=since, start_time__lte=timezone.now(),
+                                            lateness__isnull=False)
+    for value in started.values_list('lateness', flat=True):
+        lateness.observe(value)
+
+
+@register_collector
+def collect_task_usage(registry: Registry):
+    """Resource usage of recorder tasks ended in metrics window, summed per channel and profile.
+
+    Profile is the task name: record, a resize size or renditions.
+    """
+    labels = ('channel', 'profile')
+    tasks = registry.gauge('recorder_tasks_measured', 'Tasks with resource usage.', labels=labels)
+    cpu = registry.gauge('recorder_task_cpu_seconds', 'User and system CPU time of tasks.', labels=labels)
+    wall = registry.gauge('recorder_task_wall_seconds', 'Wall time of task processes.', labels=labels)
+    rss = registry.gauge('recorder_task_max_rss_bytes', 'Largest resident set size of a task.', labels=labels)
+    io = registry.gauge('recorder_task_io_bytes', 'Bytes read and written by tasks, from block counts.',
+                        labels=labels)
+
+    since = timezone.now() - timezone.timedelta(seconds=settings.METRICS_WINDOW)
+    measured = Task.objects.all().filter(ended_at__gte=since, cpu_user__isnull=False, queue__schedule__isnull=False)
+    rows = measured.values('queue__schedule__channel__name', 'name').annotate(
+        count=Count('id'), cpu=Sum(F('cpu_user') + F('cpu_system')), wall=Sum('wall_time'), rss=Max('max_rss'),
+        blocks=Sum(F('block_in') + F('block_out'))).order_by()
+    for row in rows:
+        values = {'channel': row['queue__schedule__channel__name'], 'profile': row['name'] or ''}
+        tasks.set(row['count'], **values)
+        cpu.set(row['cpu'] or 0, **values)
+        wall.set(row['wall'] or 0, **values)
+        rss.set((row['rss'] or 0) * 1024, **values)
+        io.set((row['blocks'] or 0) * 512, **values)
@@ -1,18 +1,21 @@
+import csv
 import os
+import shutil
+from datetime import datetime
 from logging import getLogger
 
 from django.conf import settings
 from django.contrib.auth import get_user_model
 from django.contrib.contenttypes.fields import GenericForeignKey
 from django.contrib.contenttypes.models import ContentType
-from django.contrib.postgres.fields import JSONField
+from django.contrib.postgres.fields import ArrayField, JSONField
 from django.core.files.base import ContentFile
 from django.core.validators import FileExtensionValidator, MinLengthValidator, URLValidator
 from django.db import models
 from django.utils import timezone
 from django.utils.translation import ugettext_lazy as _
 
-from command.models import Queue
+from command.models import Queue, QueueStatus
 from ffmpeg.utils import ChoiceEnum
 from ffmpeg.ffprobe import get_file_attributes
 from ffmpeg.filters import FOAR
@@ -90,8 +93,22 @@ class Schedule(models.Model):
     resize = models.CharField(max_length=10, choices=VIDEO_SIZES, null=True, blank=True, verbose_name=_("Resize"))
     foar = models.CharField(verbose_name=_("Force Original Aspect Ratio"), max_length=10, choices=FOAR.choices(),
                             default=FOAR.Disable)
+    # Resized output is written by the record process itself instead of a second task reading the recording
+    live_resize = models.BooleanField(default=False, verbose_name=_("Resize While Recording"))
+    keep_original = models.BooleanField(default=True, verbose_name=_("Keep Original"))
+    # Sizes produced by a single process from one decode of the recording
+    renditions = ArrayField(models.CharField(max_length=10, choices=VIDEO_SIZES), null=True, blank=True,
+                            verbose_name=_("Renditions"))
+    # Recorded as fixed length chunks which are concatenated when recording ends
+    segmented = models.BooleanField(default=False, verbose_name=_("Segmented Recording"))
+
+    # Seconds recording started after start time, its duration is shortened as much
+    lateness = models.FloatField(null=True, blank=True, verbose_name=_('Lateness Seconds'))
 
     queue = models.OneToOneField(Queue, null=True, blank=True, on_delete=models.CASCADE)
+    # Shared recording of the channel the window is cut from, set if RECORD_SHARED_INGEST is enabled
+    ingest = models.ForeignKey('Ingest', null=True, blank=True, related_name='schedules', on_delete=models.SET_NULL,
+                               verbose_name=_('Ingest'))
     user = models.ForeignKey(User, on_delete=models.CASCADE)
     created_at = models.DateTimeField(auto_now_add=True, verbose_name=_('Created Time'))
     updated_at = models.DateTimeField(auto_now=True, verbose_name=_('Last Update Time'))
@@ -109,6 +126,60 @@ class Schedule(models.Model):
         return self.start_time + timezone.timedelta(hours=self.time.hour, minutes=self.time.minute,
                                                     seconds=self.time.second)
 
+    def get_segment_dir(self) -> str:
+        return os.path.join(settings.MEDIA_ROOT, 'segments', str(self.id))
+
+    def get_segment_list_path(self) -> str:
+        """List of finished segments written by ffmpeg segment muxer as 'file,start,end' lines."""
+        return os.path.join(self.get_segment_dir(), 'segments.csv')
+
+    def get_concat_list_path(self) -> str:
+        return os.path.join(self.get_segment_dir(), 'concat.txt')
+
+    def sync_segments(self) -> int:
+        """Adds segments finished since last sync, returns how many added."""
+        path = self.get_segment_list_path()
+        if not os.path.exists(path):
+            return 0
+
+        with open(path, newline='') as f:
+            rows = [row for row in csv.reader(f) if len(row) >= 3]
+        known = set(self.segments.values_list('index', flat=True))
+        segments = []
+        for name, start, end in (row[:3] for row in rows):
+            # Numbered by file name, list is written again from the start when recording is relaunched
+            index = int(os.path.splitext(name)[0])
+            if index in known:
+                continue
+            file = os.path.join(self.get_segment_dir(), name)
+            size = os.path.getsize(file) if os.path.exists(file) else 0
+            segments.append(Segment(schedule=self, index=index, file=file, start=float(start), end=float(end),
+                                    size=size))
+        Segment.objects.bulk_create(segments)
+        if segments:
+            logger.debug("Schedule<%d>: %d segment added." % (self.id, len(segments)))
+        return len(segments)
+
+    def next_segment_index(self) -> int:
+        """Number after the last segment file, a relaunched recording continues from it."""
+        if not os.path.isdir(self.get_segment_dir()):
+            return 0
+        indexes = [int(name[:-3]) for name in os.listdir(self.get_segment_dir())
+                   if name.endswith('.ts') and name[:-3].isdigit()]
+        return max(indexes) + 1 if indexes else 0
+
+    def write_concat_list(self) -> str:
+        """Writes list of segments in concat demuxer format, returns its path."""
+        path = self.get_concat_list_path()
+        with open(path, 'w') as f:
+            for file in self.segments.order_by('index').values_list('file', flat=True):
+                f.write("file '%s'\n" % file.replace("'", "'\\''"))
+        return path
+
+    def delete_segments(self):
+        self.segments.all().delete()
+        shutil.rmtree(self.get_segment_dir(), ignore_errors=True)
+
     class Meta:
         verbose_name = _("Schedule")
         verbose_name_plural = _("Schedules")
@@ -120,7 +191,13 @@ class Schedule(models.Model):
     def delete(self, **kwargs):
         if self.queue:
             self.queue.delete()
-        return super(Schedule, self).delete(**kwargs)
+        if self.segmented or self.ingest_id:
+            self.delete_segments()
+        ingest = self.ingest
+        deleted = super(Schedule, self).delete(**kwargs)
+        if ingest:
+            ingest.release()
+        return deleted
 
     def _set_status(self, stat: ScheduleStatus):
         if self.status == stat:
@@ -154,6 +231,107 @@ class Schedule(models.Model):
         self._set_status(ScheduleStatus.Error)
 
 
+class Segment(models.Model):
+    schedule = models.ForeignKey('Schedule', related_name='segments', on_delete=models.CASCADE)
+    index = models.PositiveIntegerField(verbose_name=_("Index"))
+    file = models.CharField(max_length=255, verbose_name=_("File"))
+    start = models.FloatField(verbose_name=_("Start Second"))
+    end = models.FloatField(verbose_name=_("End Second"))
+    size = models.BigIntegerField(default=0, verbose_name=_("Size"))
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name=_("Create Time"))
+
+    class Meta:
+        verbose_name = _("Segment")
+        verbose_name_plural = _("Segments")
+        ordering = ('schedule', 'index')
+        unique_together = ('schedule', 'index')
+
+    def __str__(self):
+        return "%s #%d" % (self.schedule_id, self.index)
+
+    def duration(self) -> float:
+        return self.end - self.start
+
+
+class Ingest(models.Model):
+    """Single recording of a channel shared by schedules with overlapping windows.
+
+    Stream is copied to chunks named by wall clock time they start, each schedule cuts its own window from them.
+    """
+    channel = models.ForeignKey('Channel', related_name='ingests', on_delete=models.CASCADE,
+                                verbose_name=_('Channel'))
+    start_time = models.DateTimeField(verbose_name=_('Start Time'))
+    end_time = models.DateTimeField(verbose_name=_('End Time'))
+    queue = models.OneToOneField(Queue, null=True, blank=True, on_delete=models.CASCADE)
+    created_at = models.DateTimeField(auto_now_add=True, verbose_name=_('Created Time'))
+
+    class Meta:
+        verbose_name = _("Ingest")
+        verbose_name_plural = _("Ingests")
+
+    def __str__(self):
+        return "%s %s" % (self.channel_id, self.start_time)
+
+    def get_segment_dir(self) -> str:
+        return os.path.join(settings.MEDIA_ROOT, 'ingests', str(self.id))
+
+    def is_started(self) -> bool:
+        return bool(self.queue) and self.queue.status != QueueStatus.Created
+
+    def covers(self, start_time, end_time) -> bool:
+        return self.start_time <= start_time and end_time <= self.end_time
+
+    def chunks(self) -> list:
+        """Chunks written so far as (start time, path) in time order, file names are their unix time."""
+        if not os.path.isdir(self.get_segment_dir()):
+            return []
+        tz = timezone.utc if settings.USE_TZ else None
+        chunks = [(datetime.fromtimestamp(int(name[:-3]), tz), os.path.join(self.get_segment_dir(), name))
+                  for name in os.listdir(self.get_segment_dir()) if name.endswith('.ts') and name[:-3].isdigit()]
+        return sorted(chunks)
+
+    def write_cut_list(self, path: str, start_time, end_time) -> int:
+        """Writes chunks overlapping the window in concat demuxer format, trimmed at window edges with inpoint and
+        outpoint. Returns how many chunks listed.
+        """
+        chunks = self.chunks()
+        lines = []
+        for i, (chunk_start, file) in enumerate(chunks):
+            # Chunk lasts until the next one starts, last one is still written or ended with the ingest
+            chunk_end = chunks[i + 1][0] if i + 1 < len(chunks) else None
+            if chunk_start >= end_time or (chunk_end is not None and chunk_end <= start_time):
+                continue
+            lines.append("file '%s'" % file.replace("'", "'\\''"))
+            if chunk_start < start_time:
+                lines.append("inpoint %.3f" % (start_time - chunk_start).total_seconds())
+            if chunk_end is None or chunk_end > end_time:
+                lines.append("outpoint %.3f" % (end_time - chunk_start).total_seconds())
+        os.makedirs(os.path.dirname(path), exist_ok=True)
+        with open(path, 'w') as f:
+            f.writelines(line + '\n' for line in lines)
+        return sum(line.startswith('file ') for line in lines)
+
+    def release(self) -> bool:
+        """Deletes chunks once no schedule waits for them, ingest not started yet is deleted with its queue.
+
+        Returns True if released.
+        """
+        if self.schedules.filter(status__in=[ScheduleStatus.Scheduled.value, ScheduleStatus.Processing.value]).exists():
+            return False
+        if not self.is_started():
+            logger.info("Ingest<%d>: Not needed by any schedule, deleted before start." % self.id)
+            if self.queue:
+                self.queue.delete()
+            else:
+                self.delete()
+            return True
+        if self.queue.status == QueueStatus.Processing:
+            return False
+        logger.debug("Ingest<%d>: Deleting chunks." % self.id)
+        shutil.rmtree(self.get_segment_dir(), ignore_errors=True)
+        return True
+
+
 class VideoFormat(ChoiceEnum):
     MP4 = "mp4"
     AVI = "avi"
@@ -174,6 +352,8 @@ class Video(models.Model):
                               choices=VideoFormat.choices())
 
     attr = JSONField(verbose_name=_("Attributes"), null=True, blank=True)
+    # Stream lost while recording as [start, end] seconds from recording start
+    gaps = JSONField(verbose_name=_("Gaps"), null=True, blank=True)
 
     created_at = models.DateTimeField(auto_now_add=True, verbose_name=_("Create Time"))
     updated_at = models.DateTimeField(auto_now=True, verbose_name=_("Last Update"))
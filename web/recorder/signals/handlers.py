@@ -1,21 +1,30 @@
+import os
+import re
+import shlex
 from logging import getLogger
 
+from django.conf import settings
 from django.db.models.signals import post_save
 from django.dispatch import receiver
 from django.utils import timezone
 
-from command.models import Queue, Task, QueueStatus
+from command.models import Queue, Task, QueueStatus, ResourceClass, TaskStatus
+from command.signals import queue_preparing, task_restarting, task_running, task_starting
 
 from ffmpeg.generator import Command
 from ffmpeg.codecs import Codec
 from ffmpeg.utils import LogLevel
 from ffmpeg.filters import BitstreamChannelFilter, FFmpegFilter, FOAR, ScaleFilter, StreamSpecifier
 
-from recorder.models import Schedule, Video
+from recorder.models import Channel, Ingest, Schedule, Video
+from recorder.streams import cache as stream_cache, is_playlist
 from recorder.utils import generate_random_string
 
 logger = getLogger('recorder.signals.handlers')
 
+# Largest task timeout, a time field can not hold a day
+MAX_TIMEOUT = timezone.timedelta(hours=23, minutes=59, seconds=59)
+
 
 def generate_record_command(input: str, output: str, duration: str, overwrite: bool = True) -> Command:
     """Returns: ffmpeg -i 'INPUT' -y -c copy -bsf:a aac_adtstoasc -t DURATION OUTPUT"""
@@ -47,6 +56,123 @@ def generate_resize_command(input: str, output: str, width: int, height: int, fo
         raise
 
 
+def generate_segment_command(input: str, directory: str, duration: str, segment_time: int,
+                             start_number: int = 0) -> str:
+    """Records to fixed length chunks, finished ones are listed in DIRECTORY/segments.csv.
+
+    Returns: ffmpeg -y -i INPUT -c copy -t DURATION -f segment -segment_time N -segment_start_number START
+        -reset_timestamps 1 -segment_format mpegts -segment_list DIRECTORY/segments.csv -segment_list_type csv
+        DIRECTORY/%06d.ts
+    """
+    args = ['ffmpeg', '-loglevel', 'error', '-y', '-i', input, '-c', 'copy', '-t', duration, '-f', 'segment',
+            '-segment_time', str(segment_time), '-segment_start_number', str(start_number), '-reset_timestamps', '1',
+            '-segment_format', 'mpegts', '-segment_list', os.path.join(directory, 'segments.csv'),
+            '-segment_list_type', 'csv', os.path.join(directory, '%06d.ts')]
+    command = ' '.join(shlex.quote(arg) for arg in args)
+    logger.debug("Segment command generated: %s" % command)
+    return command
+
+
+def generate_ingest_command(input: str, directory: str, duration: str, segment_time: int) -> str:
+    """Records to chunks aligned to wall clock and named by unix time they start.
+
+    Returns: ffmpeg -y -i INPUT -c copy -t DURATION -f segment -segment_time N -segment_atclocktime 1 -strftime 1
+        -reset_timestamps 1 -segment_format mpegts DIRECTORY/%s.ts
+    """
+    args = ['ffmpeg', '-loglevel', 'error', '-y', '-i', input, '-c', 'copy', '-t', duration, '-f', 'segment',
+            '-segment_time', str(segment_time), '-segment_atclocktime', '1', '-strftime', '1', '-reset_timestamps',
+            '1', '-segment_format', 'mpegts', os.path.join(directory, '%s.ts')]
+    command = ' '.join(shlex.quote(arg) for arg in args)
+    logger.debug("Ingest command generated: %s" % command)
+    return command
+
+
+def generate_concat_command(concat_list: str, output: str) -> str:
+    """Returns: ffmpeg -y -f concat -safe 0 -i CONCAT_LIST -c copy -bsf:a aac_adtstoasc OUTPUT"""
+    args = ['ffmpeg', '-loglevel', 'error', '-y', '-f', 'concat', '-safe', '0', '-i', concat_list, '-c', 'copy',
+            '-bsf:a', 'aac_adtstoasc', output]
+    command = ' '.join(shlex.quote(arg) for arg in args)
+    logger.debug("Concat command generated: %s" % command)
+    return command
+
+
+def set_duration(command: str, seconds: float) -> str:
+    """Sets every -t option of the command to `seconds`, e.g. for a recording started early or late."""
+    return re.sub(r'(?<=\s-t\s)\S+', '%.3f' % seconds, command)
+
+
+def replace_input(command: str, url: str, resolved: str) -> str:
+    """Replaces `url` arguments of the command with `resolved`."""
+    return ' '.join(shlex.quote(resolved if arg == url else arg) for arg in shlex.split(command))
+
+
+def get_duration(schedule: Schedule) -> float:
+    """Expected length of recorded video in seconds, used for task progress."""
+    return float(schedule.time.hour * 3600 + schedule.time.minute * 60 + schedule.time.second)
+
+
+def generate_scale_output(output: str, width: int, height: int, foar: FOAR, duration: str) -> str:
+    """Returns second output of a record command: -t DURATION -vf scale=WIDTH:HEIGHT OUTPUT"""
+    return "-t %s -vf %s %s" % (shlex.quote(duration), shlex.quote(_scale(width, height, foar)),
+                                shlex.quote(output))
+
+
+def generate_live_resize_command(input: str, output: str, duration: str, width: int, height: int, foar: FOAR,
+                                 original: str = None) -> str:
+    """Records and scales in one process, original stream is copied to `original` too if it is given."""
+    if original:
+        return "%s %s" % (generate_record_command(input=input, output=original, duration=duration),
+                          generate_scale_output(output, width, height, foar, duration))
+
+    data = {'input': input, 'output': output, 'loglevel': LogLevel.Error, 'overwrite': True, 'duration': duration}
+    try:
+        cmd = Command(**data)
+        cmd.add_filter(ScaleFilter(width=width, height=height, foar=foar))
+        logger.debug("Live resize command generated: %s" % cmd.generate())
+        return cmd.generate()
+    except Exception:
+        logger.exception("Live resize Command can not generated.\nData: %s" % data)
+        raise
+
+
+def _scale(width: int, height: int, foar: FOAR) -> str:
+    scale = 'scale=%d:%d' % (width, height)
+    if foar and foar != FOAR.Disable:
+        scale += ':force_original_aspect_ratio=%s' % foar.name.lower()
+    return scale
+
+
+def generate_renditions_command(input: str, outputs: list, foar: FOAR) -> str:
+    """Decodes input once, splits video to a scaled output for each of `outputs` as (output, width, height).
+
+    Returns: ffmpeg -y -i INPUT -filter_complex '[0:v]split=2[v0][v1];[v0]scale=W:H[o0];...'
+        -map '[o0]' -map '0:a?' OUTPUT0 -map '[o1]' -map '0:a?' OUTPUT1
+    """
+    graph = ['[0:v]split=%d%s' % (len(outputs), ''.join('[v%d]' % i for i in range(len(outputs))))]
+    graph += ['[v%d]%s[o%d]' % (i, _scale(width, height, foar), i) for i, (_, width, height) in enumerate(outputs)]
+    args = ['ffmpeg', '-loglevel', 'error', '-y', '-i', input, '-filter_complex', ';'.join(graph)]
+    for i, (output, _, _) in enumerate(outputs):
+        args += ['-map', '[o%d]' % i, '-map', '0:a?', output]
+    command = ' '.join(shlex.quote(arg) for arg in args)
+    logger.debug("Renditions command generated: %s" % command)
+    return command
+
+
+def clamp_timeout(timeout: timezone.timedelta) -> timezone.timedelta:
+    """Task timeout is a time field, a day or longer is limited to its largest value instead of "1 day, 0:01:00"."""
+    return min(timeout, MAX_TIMEOUT)
+
+
+def get_deadline(end_time: timezone.datetime) -> timezone.datetime:
+    """Time after which a recording ending at `end_time` is not started, too little of it would be recorded."""
+    return end_time - timezone.timedelta(seconds=settings.RECORD_MIN_SECONDS)
+
+
+def get_timeout(schedule: Schedule) -> timezone.timedelta:
+    return clamp_timeout(timezone.timedelta(hours=schedule.time.hour, minutes=schedule.time.minute + 1,
+                                            seconds=schedule.time.second))
+
+
 def create_video_file(task: Task) -> Video:
     try:
         v = Video(name=generate_random_string(8))
@@ -61,9 +187,8 @@ def create_video_file(task: Task) -> Video:
 
 def create_recod_task(schedule: Schedule) -> (Task, Video):
     try:
-        timeout = timezone.timedelta(hours=schedule.time.hour, minutes=schedule.time.minute + 1,
-                                     seconds=schedule.time.second)
-        task = Task.objects.create(timeout=str(timeout))
+        task = Task.objects.create(shell=False, name='record', timeout=str(get_timeout(schedule)),
+                                   resource=ResourceClass.IO.value, duration=get_duration(schedule))
         output_file = create_video_file(task)
 
         task.command = generate_record_command(input=schedule.channel.url, output=output_file.file.path,
@@ -76,10 +201,122 @@ def create_recod_task(schedule: Schedule) -> (Task, Video):
     return task, output_file
 
 
+def create_segment_task(schedule: Schedule) -> Task:
+    """Record task of a segmented schedule, its output is the segment directory instead of a Video."""
+    try:
+        directory = schedule.get_segment_dir()
+        os.makedirs(directory, exist_ok=True)
+        # Relaunched if stream drops, new segments are added to the ones already recorded
+        task = Task.objects.create(shell=False, name='record', timeout=str(get_timeout(schedule)), restart=True,
+                                   resource=ResourceClass.IO.value, duration=get_duration(schedule))
+        task.command = generate_segment_command(input=schedule.channel.url, directory=directory,
+                                                duration=str(schedule.time),
+                                                segment_time=settings.RECORD_SEGMENT_SECONDS)
+        task.save(update_fields=['command'])
+        logger.info("Segment task created for Schedule<%d>" % schedule.id)
+    except Exception:
+        logger.exception("Create Segment Task failed.")
+        raise
+    return task
+
+
+def create_concat_task(schedule: Schedule, dependence: Task) -> (Task, Video):
+    try:
+        # Finished segments are stitched also when recording fails or is terminated
+        task = Task.objects.create(shell=False, name='concat', depends=dependence, always_run=True,
+                                   resource=ResourceClass.IO.value, duration=get_duration(schedule))
+        output_file = create_video_file(task)
+        task.command = generate_concat_command(concat_list=schedule.get_concat_list_path(),
+                                               output=output_file.file.path)
+        task.save(update_fields=['command'])
+        logger.info("Concat task created for Schedule<%d>" % schedule.id)
+    except Exception:
+        logger.exception("Create Concat Task failed.")
+        raise
+    return task, output_file
+
+
+def get_ingest_timeout(start_time: timezone.datetime, end_time: timezone.datetime) -> timezone.timedelta:
+    """Timeout of an ingest task recording the window, a minute longer so the last chunk is finished."""
+    return timezone.timedelta(seconds=int((end_time - start_time).total_seconds()) + 60)
+
+
+def update_ingest_task(ingest: Ingest, task: Task):
+    """Sets the ingest task to record whole window of the ingest from the time it starts."""
+    seconds = (ingest.end_time - ingest.start_time).total_seconds()
+    task.timeout = str(clamp_timeout(get_ingest_timeout(ingest.start_time, ingest.end_time)))
+    task.duration = seconds
+    task.command = generate_ingest_command(input=ingest.channel.url, directory=ingest.get_segment_dir(),
+                                           duration='%d' % seconds, segment_time=settings.RECORD_SEGMENT_SECONDS)
+    task.save(update_fields=['timeout', 'duration', 'command'])
+
+
+def create_ingest(schedule: Schedule) -> Ingest:
+    try:
+        ingest = Ingest.objects.create(channel=schedule.channel, start_time=schedule.start_time,
+                                       end_time=schedule.end_time())
+        os.makedirs(ingest.get_segment_dir(), exist_ok=True)
+        # Relaunched if stream drops, chunks are named by time so new ones are added after the ones recorded
+        task = Task.objects.create(shell=False, name='ingest', restart=True, resource=ResourceClass.IO.value)
+        update_ingest_task(ingest, task)
+        ingest.queue = Queue.objects.create(timer=ingest.start_time, deadline=get_deadline(ingest.end_time))
+        ingest.queue.add(task)
+        ingest.save(update_fields=['queue'])
+        logger.info("Ingest<%d> created for Channel<%d>" % (ingest.id, schedule.channel_id))
+    except Exception:
+        logger.exception("Create Ingest failed.")
+        raise
+    return ingest
+
+
+def get_ingest(schedule: Schedule) -> Ingest:
+    """Ingest of the channel which records window of the schedule, created if there is not one.
+
+    Ingest not started yet is extended to cover the window as long as its timeout can hold it, a running one is
+    shared only if it covers the window.
+    """
+    start_time, end_time = schedule.start_time, schedule.end_time()
+    ingests = Ingest.objects.filter(channel=schedule.channel, start_time__lte=end_time, end_time__gte=start_time)
+    for ingest in ingests.filter(queue__status=QueueStatus.Created.value):
+        start, end = min(ingest.start_time, start_time), max(ingest.end_time, end_time)
+        if get_ingest_timeout(start, end) > MAX_TIMEOUT:
+            # It would be stopped before the end of the window
+            continue
+        ingest.start_time, ingest.end_time = start, end
+        ingest.save(update_fields=['start_time', 'end_time'])
+        update_ingest_task(ingest, ingest.queue.tasks().get())
+        ingest.queue.timer, ingest.queue.deadline = ingest.start_time, get_deadline(ingest.end_time)
+        ingest.queue.save(update_fields=['timer', 'deadline'])
+        logger.info("Ingest<%d> extended for Schedule<%d>" % (ingest.id, schedule.id))
+        return ingest
+    for ingest in ingests.filter(queue__status=QueueStatus.Processing.value):
+        if ingest.covers(start_time, end_time):
+            return ingest
+    return create_ingest(schedule)
+
+
+def create_cut_task(schedule: Schedule) -> (Task, Video):
+    """Task copying window of the schedule out of its ingest chunks, list of them is written when it starts."""
+    try:
+        os.makedirs(schedule.get_segment_dir(), exist_ok=True)
+        task = Task.objects.create(shell=False, name='cut', resource=ResourceClass.IO.value,
+                                   duration=get_duration(schedule))
+        output_file = create_video_file(task)
+        task.command = generate_concat_command(concat_list=schedule.get_concat_list_path(),
+                                               output=output_file.file.path)
+        task.save(update_fields=['command'])
+        logger.info("Cut task created for Schedule<%d>" % schedule.id)
+    except Exception:
+        logger.exception("Create Cut Task failed.")
+        raise
+    return task, output_file
+
+
 def create_resize_task(schedule: Schedule, file: Video, dependence: Task = None) -> (Task, Video):
     try:
 
-        task = Task.objects.create(depends=dependence)
+        task = Task.objects.create(shell=False, name=schedule.resize, depends=dependence,
+                                   resource=ResourceClass.CPU.value, duration=get_duration(schedule))
         output_file: Video = create_video_file(task)
         width, height = schedule.resize.split('x')
         task.command = generate_resize_command(input=file.file.path, output=output_file.file.path, width=int(width),
@@ -92,14 +329,94 @@ def create_resize_task(schedule: Schedule, file: Video, dependence: Task = None)
     return task, output_file
 
 
+def create_live_resize_task(schedule: Schedule) -> (Task, Video):
+    try:
+        # Captures live stream, so it runs with recordings instead of waiting behind transcodes
+        task = Task.objects.create(shell=False, name='live %s' % schedule.resize, timeout=str(get_timeout(schedule)),
+                                   resource=ResourceClass.IO.value, duration=get_duration(schedule))
+        # Original is created first, resized one is the last video of the task
+        original_file = create_video_file(task) if schedule.keep_original else None
+        output_file = create_video_file(task)
+        width, height = schedule.resize.split('x')
+        task.command = generate_live_resize_command(
+            input=schedule.channel.url, output=output_file.file.path, duration=str(schedule.time), width=int(width),
+            height=int(height), foar=schedule.get_foar(), original=original_file.file.path if original_file else None)
+        task.save(update_fields=['command'])
+        logger.info("Live resize task created for Schedule<%d>" % schedule.id)
+    except Exception:
+        logger.exception("Create Live Resize Task failed.")
+        raise
+    return task, output_file
+
+
+def create_renditions_task(schedule: Schedule, file: Video, dependence: Task = None) -> (Task, list):
+    try:
+        task = Task.objects.create(shell=False, name='renditions', resource=ResourceClass.CPU.value,
+                                   duration=get_duration(schedule))
+        if dependence:
+            task.requires.add(dependence)
+        outputs, files = [], []
+        for size in schedule.renditions:
+            width, height = size.split('x')
+            output_file = create_video_file(task)
+            files.append(output_file)
+            outputs.append((output_file.file.path, int(width), int(height)))
+        task.command = generate_renditions_command(input=file.file.path, outputs=outputs, foar=schedule.get_foar())
+        task.save(update_fields=['command'])
+        logger.info("Renditions task created for Schedule<%d>" % schedule.id)
+    except Exception:
+        logger.exception("Create Renditions Task failed.")
+        raise
+    return task, files
+
+
+def delete_intermediate_files(queue: Queue):
+    """Deletes videos of tasks which other tasks of the queue made outputs from, e.g. the original recording."""
+    tasks = list(queue.tasks())
+    sources = {task.depends_id for task in tasks if task.depends_id}
+    for task in tasks:
+        sources.update(required.id for required in task.requires.all())
+    for task in tasks:
+        if task.id not in sources:
+            continue
+        for video in Video.get_object_by_related(task):
+            logger.debug("Deleting intermediate Video<%d> of Queue<%d>." % (video.id, queue.id))
+            video.delete()
+
+
 def create_instance_queue(sch: Schedule):
-    queue = Queue.objects.create(timer=sch.start_time)
-    record_task, record_file = create_recod_task(sch)
+    queue = Queue.objects.create(timer=sch.start_time, deadline=get_deadline(sch.end_time()))
+    # Renditions need the recording, so live resize is only used without them
+    if sch.resize and sch.live_resize and not sch.renditions and not sch.segmented:
+        task, _ = create_live_resize_task(sch)
+        queue.add(task)
+        return queue
+
+    if settings.RECORD_SHARED_INGEST:
+        # Window is cut when the chunk it ends in is finished
+        sch.ingest = get_ingest(sch)
+        sch.save(update_fields=['ingest'])
+        # Cut after the window, so it has no deadline
+        queue.timer = sch.end_time() + timezone.timedelta(
+            seconds=settings.RECORD_SEGMENT_SECONDS + settings.DAEMON_PREROLL + 2)
+        queue.deadline = None
+        queue.save(update_fields=['timer', 'deadline'])
+        record_task, record_file = create_cut_task(sch)
+    elif sch.segmented:
+        # Concat task stitches the segments, its output is used as the recording
+        segment_task = create_segment_task(sch)
+        record_task, record_file = create_concat_task(sch, dependence=segment_task)
+    else:
+        record_task, record_file = create_recod_task(sch)
     queue.add(record_task)
 
     if sch.resize:
         resize_task, resize_file = create_resize_task(schedule=sch, file=record_file, dependence=record_task)
         queue.add(resize_task)
+    if sch.renditions:
+        # Runs at the same time with resize task, both only need the recording
+        renditions_task, _ = create_renditions_task(schedule=sch, file=record_file, dependence=record_task)
+        queue.add(renditions_task)
     return queue
 
 
@@ -115,6 +432,19 @@ def on_schedule_save(instance: Schedule, created, **kwargs):
             raise
 
 
+def set_partial_file(schedule: Schedule, queue: Queue):
+    """Keeps what a failed or stopped recording wrote as the schedule's file, last video of the tasks which completed
+    or were terminated. Terminated ffmpeg is interrupted first, so its output is finalized.
+    """
+    tasks = queue.tasks().filter(status__in=[TaskStatus.Completed.value, TaskStatus.Terminated.value])
+    for task in reversed(list(tasks)):
+        v: Video or None = Video.get_object_by_related(task).order_by('id').last()
+        if v:
+            schedule.file = v.file
+            schedule.save(update_fields=['file'])
+            return
+
+
 @receiver(post_save, sender=Queue)
 def on_queue_status_change(instance: Queue, created, **kwargs):
     if not created:
@@ -124,14 +454,182 @@ def on_queue_status_change(instance: Queue, created, **kwargs):
                 s.set_status_timeout()
             elif instance.status == QueueStatus.Error:
                 s.set_status_error()
+                if s.segmented:
+                    set_partial_file(s, instance)
+            elif instance.status == QueueStatus.Stopped:
+                # Terminated on request or timeout, what was recorded until then is kept
+                s.set_status_canceled()
+                set_partial_file(s, instance)
             elif instance.status == QueueStatus.Processing:
                 s.set_status_processing()
             elif instance.status == QueueStatus.Completed:
                 s.set_status_completed()
                 try:
-                    v: Video = Video.get_object_by_related(instance.tasks().last()).first()
+                    v: Video = Video.get_object_by_related(instance.tasks().last()).order_by('id').last()
                     s.file = v.file
                     s.save()
+                    if (s.resize or s.renditions) and not s.keep_original:
+                        delete_intermediate_files(instance)
+                    if s.segmented or s.ingest_id:
+                        s.delete_segments()
                 except Exception:
                     logger.exception("Schedule<%d> status can not change Completed" % s.id)
                     raise
+            if s.ingest_id and instance.status not in (QueueStatus.Created, QueueStatus.Processing):
+                s.ingest.release()
+            return
+
+        ingest: Ingest or None = Ingest.objects.filter(queue=instance).first()
+        if ingest and instance.status not in (QueueStatus.Created, QueueStatus.Processing):
+            ingest.release()
+
+
+def get_segmented_schedule(task: Task) -> Schedule or None:
+    if task.name != 'record' or not task.queue_id:
+        return None
+    return Schedule.objects.filter(queue_id=task.queue_id, segmented=True).first()
+
+
+@receiver(task_running, sender=Task)
+def on_task_running(task: Task, **kwargs):
+    s = get_segmented_schedule(task)
+    if s:
+        s.sync_segments()
+
+
+@receiver(post_save, sender=Task)
+def on_record_task_end(instance: Task, created, update_fields=None, **kwargs):
+    """Finished segments are kept and listed for the concat task, also when recording failed."""
+    if created or update_fields is None or 'ended_at' not in update_fields:
+        return
+    if instance.status not in (TaskStatus.Completed, TaskStatus.Error, TaskStatus.Terminated):
+        return
+    s = get_segmented_schedule(instance)
+    if s:
+        try:
+            s.sync_segments()
+            s.write_concat_list()
+        except Exception:
+            logger.exception("Segments of Schedule<%d> can not listed." % s.id)
+
+
+def get_recording(task: Task) -> (Channel, list, timezone.datetime, timezone.datetime) or None:
+    """Channel, schedules and window recorded by the task, None if it is not a recording task."""
+    # Only recording tasks have a timeout
+    if task.timeout is None or not task.queue_id:
+        return None
+    ingest = Ingest.objects.filter(queue_id=task.queue_id).first()
+    if ingest:
+        return ingest.channel, list(ingest.schedules.all()), ingest.start_time, ingest.end_time
+    schedules = list(Schedule.objects.filter(queue_id=task.queue_id))
+    if not schedules:
+        return None
+    return schedules[0].channel, schedules, schedules[0].start_time, schedules[0].end_time()
+
+
+@receiver(task_starting, sender=Task)
+def on_record_task_starting(task: Task, **kwargs):
+    """Recording started early by pre-roll or late records until end of the window, how late it is kept on its
+    schedules.
+    """
+    recording = get_recording(task)
+    if not recording:
+        return
+    _, schedules, start_time, end_time = recording
+
+    now = timezone.now()
+    for s in schedules:
+        s.lateness = max((now - s.start_time).total_seconds(), 0)
+        s.save(update_fields=['lateness'])
+    late = (now - start_time).total_seconds()
+    if abs(late) < 1:
+        return
+    remaining = max((end_time - now).total_seconds(), 1)
+    task.command = set_duration(task.command, remaining)
+    task.duration = remaining
+    task.save(update_fields=['command', 'duration'])
+    if late > 0:
+        logger.warning("Task<%d>: Started %.1f seconds late, recording %.1f seconds." % (task.id, late, remaining))
+    else:
+        logger.info("Task<%d>: Started %.1f seconds early, recording %.1f seconds." % (task.id, -late, remaining))
+
+
+@receiver(queue_preparing, sender=Queue)
+def on_record_queue_preparing(queue: Queue, **kwargs):
+    """Resolves the HLS master playlist of a recording before pre-roll, resolved urls are cached per channel for
+    RECORD_STREAM_TTL seconds.
+    """
+    if not settings.RECORD_STREAM_TTL:
+        return
+    for task in queue.tasks():
+        recording = get_recording(task)
+        if recording:
+            channel = recording[0]
+            if is_playlist(channel.url):
+                stream_cache.get(channel.id, channel.url, settings.RECORD_STREAM_TTL)
+            return
+
+
+@receiver(task_starting, sender=Task)
+def on_record_task_resolve(task: Task, **kwargs):
+    """Records the variant of an HLS master playlist directly, so ffmpeg does not fetch and select it when window
+    opens. Only the variant resolved when the queue is prepared is used, starting does not wait on the network.
+    """
+    recording = get_recording(task)
+    if not recording or not settings.RECORD_STREAM_TTL:
+        return
+    channel = recording[0]
+    if not is_playlist(channel.url):
+        return
+    resolved = stream_cache.peek(channel.id, channel.url)
+    if resolved is None:
+        logger.debug("Task<%d>: Stream of Channel<%d> is not resolved, recording it as it is." % (task.id, channel.id))
+        return
+    if resolved != channel.url:
+        task.command = replace_input(task.command, channel.url, resolved)
+        task.save(update_fields=['command'])
+        logger.info("Task<%d>: Recording variant %s of Channel<%d>." % (task.id, resolved, channel.id))
+
+
+@receiver(task_starting, sender=Task)
+def on_cut_task_starting(task: Task, **kwargs):
+    if task.name != 'cut' or not task.queue_id:
+        return
+    s = Schedule.objects.filter(queue_id=task.queue_id).exclude(ingest=None).first()
+    if s:
+        count = s.ingest.write_cut_list(s.get_concat_list_path(), s.start_time, s.end_time())
+        logger.info("Schedule<%d>: %d chunks of Ingest<%d> listed." % (s.id, count, s.ingest_id))
+
+
+@receiver(task_restarting, sender=Task)
+def on_ingest_task_restarting(task: Task, **kwargs):
+    """Relaunches ingest for the rest of its window."""
+    ingest = Ingest.objects.filter(queue_id=task.queue_id).first() if task.name == 'ingest' else None
+    if not ingest:
+        return
+    task.command = generate_ingest_command(input=ingest.channel.url, directory=ingest.get_segment_dir(),
+                                           duration='%d' % max((ingest.end_time - timezone.now()).total_seconds(), 1),
+                                           segment_time=settings.RECORD_SEGMENT_SECONDS)
+    task.save(update_fields=['command'])
+
+
+@receiver(task_restarting, sender=Task)
+def on_record_task_restarting(task: Task, exited_at, **kwargs):
+    """Relaunches recording for the rest of the window after last segment, lost time is kept as a gap of the video."""
+    s = get_segmented_schedule(task)
+    if not s:
+        return
+    s.sync_segments()
+    passed = (timezone.now() - task.started_at).total_seconds()
+    task.command = generate_segment_command(input=s.channel.url, directory=s.get_segment_dir(),
+                                            duration='%.3f' % max(task.duration - passed, 1),
+                                            segment_time=settings.RECORD_SEGMENT_SECONDS,
+                                            start_number=s.next_segment_index())
+    task.save(update_fields=['command'])
+
+    gap = [round((exited_at - task.started_at).total_seconds(), 3), round(passed, 3)]
+    logger.warning("Schedule<%d>: Stream lost between %s and %s seconds." % (s.id, gap[0], gap[1]))
+    for concat_task in Task.objects.filter(depends=task):
+        for video in Video.get_object_by_related(concat_task):
+            video.gaps = (video.gaps or []) + [gap]
+            video.save(update_fields=['gaps'])
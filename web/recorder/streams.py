@@ -0,0 +1,94 @@
+import re
+import threading
+import time
+from logging import getLogger
+from urllib.parse import urljoin, urlparse
+from urllib.request import urlopen
+
+logger = getLogger('recorder.streams')
+
+ATTRIBUTE = re.compile(r'([A-Z0-9-]+)=("[^"]*"|[^,]*)')
+# Playlists are small, a longer response is not a playlist
+MAX_PLAYLIST_BYTES = 1024 * 1024
+
+
+def parse_attributes(value: str) -> dict:
+    """Attribute list of an HLS tag, e.g. BANDWIDTH=1280000,CODECS="avc1.4d401f,mp4a.40.2"."""
+    return {name: value.strip('"') for name, value in ATTRIBUTE.findall(value)}
+
+
+def parse_master_playlist(text: str, base_url: str) -> list:
+    """Variants of a master playlist as dicts of absolute `url`, `bandwidth` and `resolution`.
+
+    Empty if the playlist is a media playlist.
+    """
+    variants, attributes = [], None
+    for line in text.splitlines():
+        line = line.strip()
+        if line.startswith('#EXT-X-STREAM-INF:'):
+            attributes = parse_attributes(line.split(':', 1)[1])
+        elif line and not line.startswith('#') and attributes is not None:
+            bandwidth = attributes.get('BANDWIDTH', '0')
+            variants.append({'url': urljoin(base_url, line),
+                             'bandwidth': int(bandwidth) if bandwidth.isdigit() else 0,
+                             'resolution': attributes.get('RESOLUTION')})
+            attributes = None
+    return variants
+
+
+def is_playlist(url: str, content_type: str = None) -> bool:
+    return urlparse(url).path.endswith('.m3u8') or 'mpegurl' in (content_type or '').lower()
+
+
+def resolve_stream(url: str, timeout: float = 5) -> str:
+    """Variant with the highest bandwidth if url is an HLS master playlist, otherwise url itself.
+
+    Other streams are not read, only response headers are fetched.
+    """
+    with urlopen(url, timeout=timeout) as response:
+        if not is_playlist(response.geturl(), response.headers.get('Content-Type')):
+            return url
+        text = response.read(MAX_PLAYLIST_BYTES).decode('utf-8', 'replace')
+        # Redirected playlists are relative to where they are served from
+        variants = parse_master_playlist(text, response.geturl())
+    if not variants:
+        return url
+    return max(variants, key=lambda variant: variant['bandwidth'])['url']
+
+
+class StreamCache:
+    def __init__(self):
+        """Resolved stream urls by key, e.g. a channel id, so schedules of a channel resolve it once a TTL."""
+        self._entries = {}  # Key: (url, resolved url, expires)
+        self._lock = threading.Lock()
+
+    def get(self, key, url: str, ttl: float, timeout: float = 5) -> str:
+        """Resolved url of the stream, url itself if it can not be resolved."""
+        resolved = self.peek(key, url)
+        if resolved is not None:
+            return resolved
+
+        try:
+            resolved = resolve_stream(url, timeout=timeout)
+        except Exception as err:
+            logger.warning("Stream %s can not resolved: %s" % (url, err))
+            return url
+        logger.debug("Stream %s resolved to %s" % (url, resolved))
+        with self._lock:
+            self._entries[key] = (url, resolved, time.monotonic() + ttl)
+        return resolved
+
+    def peek(self, key, url: str) -> str or None:
+        """Resolved url of the stream if it is cached and not expired, never resolves it."""
+        with self._lock:
+            entry = self._entries.get(key)
+        if entry and entry[0] == url and entry[2] > time.monotonic():
+            return entry[1]
+        return None
+
+    def clear(self):
+        with self._lock:
+            self._entries.clear()
+
+
+cache = StreamCache()
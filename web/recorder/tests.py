@@ -1,13 +1,19 @@
 import os
 import random
 import string
+import threading
+from http.server import BaseHTTPRequestHandler, HTTPServer
 
 from django.contrib.auth import get_user_model
 from django.core.exceptions import ValidationError
-from django.test import TestCase
+from django.test import TestCase, override_settings
 from django.utils import timezone
 
-from recorder.models import Category, Channel, Schedule, Video, VideoFormat, FOAR, Queue
+from command.daemon import Daemon
+from command.models import QueueStatus, ResourceClass, Task, TaskStatus
+from command.signals import queue_preparing, task_restarting, task_starting
+from recorder.models import Category, Channel, Ingest, Schedule, ScheduleStatus, Video, VideoFormat, FOAR, Queue
+from recorder.streams import StreamCache, cache as stream_cache, parse_master_playlist, resolve_stream
 
 User = get_user_model()
 
@@ -146,6 +152,260 @@ class ScheduleTestCase(TestCase):
         self.create_schedule(channel=channel, name=self.generate_name(), start_time=start_time, time=time,
                              user=user, resize=resize, foar=foar)
 
+    def test_create_schedule_with_live_resize(self):
+        category = self.create_category(name=self.generate_name())
+        channel = self.create_channel(name=self.generate_name(), url=self.generate_url(), category=category)
+
+        start_time = timezone.now() + timezone.timedelta(seconds=10)
+        time = "00:01:00"
+        user = self.create_user()
+        schedule = self.create_schedule(channel=channel, name=self.generate_name(), start_time=start_time, time=time,
+                                        user=user, resize="1280x720", live_resize=True, keep_original=True)
+        tasks = list(schedule.queue.tasks())
+        self.assertEqual(len(tasks), 1)
+        self.assertIn("scale=1280:720", tasks[0].command)
+        self.assertEqual(tasks[0].resource, ResourceClass.IO.value)
+        self.assertEqual(Video.get_object_by_related(tasks[0]).count(), 2)
+
+    def test_create_schedule_with_renditions(self):
+        category = self.create_category(name=self.generate_name())
+        channel = self.create_channel(name=self.generate_name(), url=self.generate_url(), category=category)
+
+        start_time = timezone.now() + timezone.timedelta(seconds=10)
+        time = "00:01:00"
+        user = self.create_user()
+        schedule = self.create_schedule(channel=channel, name=self.generate_name(), start_time=start_time, time=time,
+                                        user=user, renditions=["1280x720", "640x360"])
+        record_task, renditions_task = schedule.queue.tasks()
+        self.assertIn("split=2", renditions_task.command)
+        self.assertEqual(list(renditions_task.requires.all()), [record_task])
+        self.assertEqual(Video.get_object_by_related(renditions_task).count(), 2)
+
+    def test_create_schedule_with_segments(self):
+        category = self.create_category(name=self.generate_name())
+        channel = self.create_channel(name=self.generate_name(), url=self.generate_url(), category=category)
+
+        start_time = timezone.now() + timezone.timedelta(seconds=10)
+        time = "00:01:00"
+        user = self.create_user()
+        schedule = self.create_schedule(channel=channel, name=self.generate_name(), start_time=start_time, time=time,
+                                        user=user, segmented=True, resize="1280x720")
+        record_task, concat_task, resize_task = schedule.queue.tasks()
+        self.assertIn("-f segment", record_task.command)
+        self.assertEqual(concat_task.depends_id, record_task.id)
+        self.assertEqual(resize_task.depends_id, concat_task.id)
+
+        # Segment muxer lists a chunk when it is finished
+        with open(schedule.get_segment_list_path(), 'w') as f:
+            f.write("000000.ts,0.000000,60.000000\n")
+        self.assertEqual(schedule.sync_segments(), 1)
+        with open(schedule.get_segment_list_path(), 'a') as f:
+            f.write("000001.ts,60.000000,90.500000\n")
+        self.assertEqual(schedule.sync_segments(), 1)
+        self.assertEqual([s.duration() for s in schedule.segments.all()], [60.0, 30.5])
+
+        with open(schedule.write_concat_list()) as f:
+            self.assertEqual(f.read().splitlines(),
+                             ["file '%s'" % os.path.join(schedule.get_segment_dir(), name)
+                              for name in ("000000.ts", "000001.ts")])
+        schedule.delete()
+        self.assertFalse(os.path.exists(schedule.get_segment_dir()))
+
+    def test_segmented_schedule_error(self):
+        category = self.create_category(name=self.generate_name())
+        channel = self.create_channel(name=self.generate_name(), url=self.generate_url(), category=category)
+        user = self.create_user()
+
+        # Failed and terminated, e.g. timed out, recordings are stitched alike
+        cases = [(TaskStatus.Error, QueueStatus.Error, ScheduleStatus.Error),
+                 (TaskStatus.Terminated, QueueStatus.Stopped, ScheduleStatus.Canceled)]
+        for task_status, queue_status, schedule_status in cases:
+            start_time = timezone.now() + timezone.timedelta(seconds=10)
+            schedule = self.create_schedule(channel=channel, name=self.generate_name(), start_time=start_time,
+                                            time="00:01:00", user=user, segmented=True)
+            queue = schedule.queue
+            record_task, concat_task = queue.tasks()
+            queue.begin()
+            with open(schedule.get_segment_list_path(), 'w') as f:
+                f.write("000000.ts,0.000000,60.000000\n")
+
+            # Stitched even though recording did not complete, queue waits for it
+            record_task.transition(task_status, ended_at=timezone.now())
+            self.assertEqual([t.id for t in queue.ready_tasks()], [concat_task.id])
+            self.assertEqual(queue._get_self().status, QueueStatus.Processing)
+            with open(schedule.get_concat_list_path()) as f:
+                self.assertIn("000000.ts", f.read())
+
+            concat_task.transition(TaskStatus.Completed)
+            self.assertEqual(queue._get_self().status, queue_status)
+            schedule.refresh_from_db()
+            self.assertEqual(schedule.status, schedule_status)
+            self.assertEqual(schedule.file, Video.get_object_by_related(concat_task).get().file)
+            schedule.delete()
+
+    def test_timeout_schedule(self):
+        category = self.create_category(name=self.generate_name())
+        channel = self.create_channel(name=self.generate_name(), url=self.generate_url(), category=category)
+
+        start_time = timezone.now() + timezone.timedelta(seconds=10)
+        user = self.create_user()
+        schedule = self.create_schedule(channel=channel, name=self.generate_name(), start_time=start_time,
+                                        time="00:01:00", user=user, resize="640x360", foar=FOAR.Increase)
+        queue = schedule.queue
+        record_task, _ = queue.tasks()
+        queue.begin()
+
+        # Recording reached its timeout, resize never runs
+        record_task.transition(TaskStatus.Terminated, ended_at=timezone.now())
+        self.assertEqual(queue._get_self().status, QueueStatus.Stopped)
+        schedule.refresh_from_db()
+        self.assertEqual(schedule.status, ScheduleStatus.Canceled)
+        self.assertEqual(schedule.file, Video.get_object_by_related(record_task).get().file)
+        schedule.delete()
+
+    def test_segmented_schedule_restart(self):
+        category = self.create_category(name=self.generate_name())
+        channel = self.create_channel(name=self.generate_name(), url=self.generate_url(), category=category)
+
+        start_time = timezone.now() + timezone.timedelta(seconds=10)
+        time = "00:01:00"
+        user = self.create_user()
+        schedule = self.create_schedule(channel=channel, name=self.generate_name(), start_time=start_time, time=time,
+                                        user=user, segmented=True)
+        record_task, concat_task = schedule.queue.tasks()
+        self.assertTrue(record_task.restart)
+
+        # Stream dropped 20 seconds after start, after first segment
+        with open(schedule.get_segment_list_path(), 'w') as f:
+            f.write("000000.ts,0.000000,20.000000\n")
+        open(os.path.join(schedule.get_segment_dir(), '000000.ts'), 'w').close()
+        now = timezone.now()
+        record_task.transition(started_at=now - timezone.timedelta(seconds=22))
+        task_restarting.send(sender=Task, task=record_task, exited_at=now - timezone.timedelta(seconds=2))
+
+        record_task = record_task._get_self()
+        self.assertIn("-segment_start_number 1", record_task.command)
+        self.assertEqual(schedule.segments.count(), 1)
+        video = Video.get_object_by_related(concat_task).get()
+        self.assertEqual([round(value) for value in video.gaps[0]], [20, 22])
+        schedule.delete()
+
+    @override_settings(RECORD_SHARED_INGEST=True, RECORD_SEGMENT_SECONDS=60)
+    def test_shared_ingest(self):
+        category = self.create_category(name=self.generate_name())
+        channel = self.create_channel(name=self.generate_name(), url=self.generate_url(), category=category)
+
+        start_time = timezone.now().replace(microsecond=0) + timezone.timedelta(seconds=10)
+        user = self.create_user()
+        first = self.create_schedule(channel=channel, name=self.generate_name(), start_time=start_time,
+                                     time="00:02:00", user=user)
+        second = self.create_schedule(channel=channel, name=self.generate_name(),
+                                      start_time=start_time + timezone.timedelta(seconds=60), time="00:02:00",
+                                      user=user)
+        self.assertEqual(Ingest.objects.filter(channel=channel).count(), 1)
+        ingest = Ingest.objects.get(channel=channel)
+        self.assertEqual((ingest.start_time, ingest.end_time), (start_time, second.end_time()))
+        self.assertIn("-t 180", ingest.queue.tasks().get().command)
+        self.assertEqual(second.queue.timer, second.end_time() + timezone.timedelta(seconds=62))
+
+        # Chunks of a minute, window of the second schedule starts and ends in the middle of one
+        begin = int(start_time.timestamp()) - 30
+        for i in range(4):
+            open(os.path.join(ingest.get_segment_dir(), '%d.ts' % (begin + i * 60)), 'w').close()
+        path = second.get_concat_list_path()
+        self.assertEqual(ingest.write_cut_list(path, second.start_time, second.end_time()), 3)
+        with open(path) as f:
+            lines = f.read().splitlines()
+        self.assertEqual([line for line in lines if not line.startswith('file ')],
+                         ['inpoint 30.000', 'outpoint 30.000'])
+
+        first.delete()
+        second.delete()
+        self.assertFalse(Ingest.objects.filter(channel=channel).exists())
+
+    @override_settings(RECORD_SHARED_INGEST=True)
+    def test_long_ingest(self):
+        category = self.create_category(name=self.generate_name())
+        channel = self.create_channel(name=self.generate_name(), url=self.generate_url(), category=category)
+
+        start_time = timezone.now().replace(microsecond=0) + timezone.timedelta(seconds=10)
+        user = self.create_user()
+        first = self.create_schedule(channel=channel, name=self.generate_name(), start_time=start_time,
+                                     time="23:00:00", user=user)
+        second = self.create_schedule(channel=channel, name=self.generate_name(),
+                                      start_time=start_time + timezone.timedelta(hours=2), time="23:00:00", user=user)
+        # Window of both is 25 hours, longer than a task timeout, so the second one gets its own ingest
+        ingests = Ingest.objects.filter(channel=channel).order_by('id')
+        self.assertEqual([(ingest.start_time, ingest.end_time) for ingest in ingests],
+                         [(first.start_time, first.end_time()), (second.start_time, second.end_time())])
+        for ingest in ingests:
+            self.assertEqual(str(ingest.queue.tasks().get().timeout), "23:01:00")
+        first.delete()
+        second.delete()
+
+    def test_late_schedule(self):
+        category = self.create_category(name=self.generate_name())
+        channel = self.create_channel(name=self.generate_name(), url=self.generate_url(), category=category)
+
+        start_time = timezone.now() - timezone.timedelta(seconds=20)
+        user = self.create_user()
+        schedule = self.create_schedule(channel=channel, name=self.generate_name(), start_time=start_time,
+                                        time="00:01:00", user=user, segmented=True)
+        record_task, concat_task = schedule.queue.tasks()
+        task_starting.send(sender=Task, task=record_task)
+        task_starting.send(sender=Task, task=concat_task)
+
+        record_task = record_task._get_self()
+        self.assertNotIn("-t 00:01:00", record_task.command)
+        self.assertAlmostEqual(record_task.duration, 40, delta=2)
+        schedule.refresh_from_db()
+        self.assertAlmostEqual(schedule.lateness, 20, delta=2)
+        self.assertEqual(concat_task._get_self().duration, 60)
+        schedule.delete()
+
+    def test_ended_schedule(self):
+        category = self.create_category(name=self.generate_name())
+        channel = self.create_channel(name=self.generate_name(), url=self.generate_url(), category=category)
+
+        # Less late than DAEMON_LATE_CUTOFF but the window is already over
+        start_time = timezone.now() - timezone.timedelta(seconds=120)
+        user = self.create_user()
+        schedule = self.create_schedule(channel=channel, name=self.generate_name(), start_time=start_time,
+                                        time="00:01:00", user=user)
+        queue = schedule.queue
+        daemon = Daemon()
+        try:
+            daemon.schedule.push(queue.id, queue.timer)
+            daemon.dispatch()
+        finally:
+            for pool in daemon.pools.values():
+                pool.shutdown(wait=False)
+        self.assertEqual(queue._get_self().status, QueueStatus.Timeout)
+        schedule.refresh_from_db()
+        self.assertEqual(schedule.status, ScheduleStatus.TimeOut)
+        schedule.delete()
+
+    def test_preroll_schedule(self):
+        category = self.create_category(name=self.generate_name())
+        # Nothing listens on the port, resolving fails at once without a lookup or a request out of the host
+        channel = self.create_channel(name=self.generate_name(), url="http://127.0.0.1:1/master.m3u8",
+                                      category=category)
+
+        start_time = timezone.now() + timezone.timedelta(seconds=5)
+        user = self.create_user()
+        schedule = self.create_schedule(channel=channel, name=self.generate_name(), start_time=start_time,
+                                        time="00:01:00", user=user, segmented=True)
+        record_task, _ = schedule.queue.tasks()
+        # Stream can not be resolved, channel url is recorded
+        task_starting.send(sender=Task, task=record_task)
+
+        record_task = record_task._get_self()
+        self.assertAlmostEqual(record_task.duration, 65, delta=2)
+        self.assertIn(channel.url, record_task.command)
+        schedule.refresh_from_db()
+        self.assertEqual(schedule.lateness, 0)
+        schedule.delete()
+
     def test_delete_schedule(self):
         category = self.create_category(name=self.generate_name())
         channel = self.create_channel(name=self.generate_name(), url=self.generate_url(), category=category)
@@ -172,3 +432,105 @@ class ScheduleTestCase(TestCase):
         queue = Queue.objects.get(id=schedule.queue.id)
         schedule.delete()
         self.assertFalse(Queue.objects.all().filter(id=queue.id).exists())
+
+
+MASTER_PLAYLIST = b"""#EXTM3U
+#EXT-X-STREAM-INF:BANDWIDTH=800000,RESOLUTION=640x360,CODECS="avc1.4d401e,mp4a.40.2"
+low/index.m3u8
+#EXT-X-STREAM-INF:BANDWIDTH=2400000,RESOLUTION=1280x720
+http://cdn.example.com/high/index.m3u8
+"""
+
+
+class PlaylistHandler(BaseHTTPRequestHandler):
+    requests = 0
+
+    def do_GET(self):
+        PlaylistHandler.requests += 1
+        if self.path == '/live':
+            # Redirected to the playlist, variants are relative to it
+            self.send_response(302)
+            self.send_header('Location', '/channel/master.m3u8')
+            self.end_headers()
+            return
+        body = MASTER_PLAYLIST if self.path == '/channel/master.m3u8' else b'\x47' * 188
+        self.send_response(200)
+        self.send_header('Content-Type', 'application/vnd.apple.mpegurl' if body == MASTER_PLAYLIST else 'video/mp2t')
+        self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+
+    def log_message(self, format, *args):
+        pass
+
+
+class StreamsTestCase(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super(StreamsTestCase, cls).setUpClass()
+        cls.server = HTTPServer(('127.0.0.1', 0), PlaylistHandler)
+        cls.url = 'http://127.0.0.1:%d' % cls.server.server_port
+        threading.Thread(target=cls.server.serve_forever, daemon=True).start()
+
+    @classmethod
+    def tearDownClass(cls):
+        cls.server.shutdown()
+        cls.server.server_close()
+        super(StreamsTestCase, cls).tearDownClass()
+
+    def test_parse_master_playlist(self):
+        variants = parse_master_playlist(MASTER_PLAYLIST.decode(), 'http://example.com/channel/master.m3u8')
+        self.assertEqual([v['url'] for v in variants], ['http://example.com/channel/low/index.m3u8',
+                                                        'http://cdn.example.com/high/index.m3u8'])
+        self.assertEqual([v['bandwidth'] for v in variants], [800000, 2400000])
+        self.assertEqual(variants[0]['resolution'], '640x360')
+
+    def test_resolve_stream(self):
+        self.assertEqual(resolve_stream(self.url + '/channel/master.m3u8'), 'http://cdn.example.com/high/index.m3u8')
+        self.assertEqual(resolve_stream(self.url + '/live'), 'http://cdn.example.com/high/index.m3u8')
+        # Not a playlist
+        self.assertEqual(resolve_stream(self.url + '/stream.ts'), self.url + '/stream.ts')
+
+    def test_cache(self):
+        cache = StreamCache()
+        url = self.url + '/channel/master.m3u8'
+        requests = PlaylistHandler.requests
+        self.assertEqual(cache.get(1, url, ttl=60), 'http://cdn.example.com/high/index.m3u8')
+        self.assertEqual(cache.get(1, url, ttl=60), 'http://cdn.example.com/high/index.m3u8')
+        self.assertEqual(PlaylistHandler.requests, requests + 1)
+        self.assertEqual(cache.peek(1, url), 'http://cdn.example.com/high/index.m3u8')
+        # Unreachable stream is recorded as it is
+        self.assertEqual(cache.get(2, 'http://127.0.0.1:1/master.m3u8', ttl=60), 'http://127.0.0.1:1/master.m3u8')
+        # Peeking never resolves
+        self.assertIsNone(cache.peek(3, url))
+        self.assertEqual(PlaylistHandler.requests, requests + 1)
+
+    def test_prepare_recording(self):
+        category = ScheduleTestCase.create_category(name=ScheduleTestCase.generate_name())
+        channel = ScheduleTestCase.create_channel(name=ScheduleTestCase.generate_name(), category=category,
+                                                  url=self.url + '/channel/master.m3u8')
+        user = User.objects.create_user(username=ScheduleTestCase.generate_name())
+        schedule = ScheduleTestCase.create_schedule(channel=channel, name=ScheduleTestCase.generate_name(), user=user,
+                                                    start_time=timezone.now() + timezone.timedelta(seconds=60),
+                                                    time="00:01:00", segmented=True)
+        queue = schedule.queue
+        daemon = Daemon()
+        try:
+            daemon.load_schedule()
+        finally:
+            for pool in daemon.pools.values():
+                pool.shutdown(wait=False)
+        self.assertIn(queue.id, daemon.preparing)
+        self.assertLess(daemon.preparing.next_deadline(), daemon.schedule.next_deadline())
+
+        stream_cache.clear()
+        requests = PlaylistHandler.requests
+        queue_preparing.send(sender=Queue, queue=queue)
+        self.assertEqual(PlaylistHandler.requests, requests + 1)
+        # Starting only reads the variant resolved while preparing
+        record_task, _ = queue.tasks()
+        task_starting.send(sender=Task, task=record_task)
+        self.assertEqual(PlaylistHandler.requests, requests + 1)
+        self.assertIn('http://cdn.example.com/high/index.m3u8', record_task._get_self().command)
+        stream_cache.clear()
+        schedule.delete()